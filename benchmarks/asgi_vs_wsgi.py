@@ -0,0 +1,74 @@
+"""
+Compare the sync (gunicorn + wsgi.py) and async (uvicorn + asgi.py) serving modes.
+
+Both servers run against the same DATABASE_URL with the same number of workers,
+with the response cache off on both sides so every request reaches the database.
+A closed-loop load generator raises the concurrency step by step (1, 2, 4, ...)
+and each mode is scored by the best throughput it sustains while its p99 latency
+stays within --latency-ms: requests/s at a fixed latency target, rather than at a
+concurrency one of the modes may already be queueing at.
+
+    DATABASE_URL=postgresql://... python benchmarks/asgi_vs_wsgi.py --workers 2 --latency-ms 50
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+from loadgen import drive, wait_until_up
+from seed import seed
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+PATHS = ["/characters?limit=20", "/characters/1", "/planets/1", "/vehicles?limit=20", "/users/favourites/1"]
+
+SERVERS = {
+    "wsgi": ["gunicorn", "wsgi:application", "--chdir", SRC, "--worker-class", "sync"],
+    "asgi": ["gunicorn", "asgi:app", "--chdir", SRC, "--worker-class", "uvicorn.workers.UvicornWorker"],
+}
+
+
+def at_latency_target(port, latency_ms, max_concurrency, duration):
+    """Best step whose p99 stays within `latency_ms`, plus every step that was run"""
+    steps, best = [], None
+    concurrency = 1
+    while concurrency <= max_concurrency:
+        summary = dict(drive(port, PATHS, concurrency, duration), concurrency=concurrency)
+        steps.append(summary)
+        if summary["p99_ms"] > latency_ms or summary["errors"]:
+            break
+        if best is None or summary["requests_per_second"] > best["requests_per_second"]:
+            best = summary
+        concurrency *= 2
+    return {"latency_target_ms": latency_ms, "best": best, "steps": steps}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--latency-ms", type=float, default=50, help="p99 latency target")
+    parser.add_argument("--max-concurrency", type=int, default=256)
+    parser.add_argument("--duration", type=float, default=5, help="seconds per concurrency step")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    # both modes do the same work per request: no response cache, no rate limit
+    os.environ["CACHE_DISABLED"] = "1"
+    os.environ["RATELIMIT_DISABLED"] = "1"
+    seed(args.rows)
+    results = {}
+    for mode, command in SERVERS.items():
+        server = subprocess.Popen(command + ["--workers", str(args.workers), "--bind", "127.0.0.1:%d" % args.port],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_up(args.port, "/characters/1")
+            results[mode] = at_latency_target(args.port, args.latency_ms, args.max_concurrency, args.duration)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Size and cost of compressing a list response, per encoding and level, and the
+time to serve it from the response cache with and without a stored compressed
+copy (the latter compresses on every hit).
+
+    python benchmarks/encodings.py --rows 10000 --page 500
+"""
+import argparse
+import os
+import sys
+import time
+
+from seed import SRC, seed
+
+
+def best_of(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--page", type=int, default=500, help="rows per list response")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ.setdefault("DATABASE_URL", "sqlite:////tmp/swapi-bench-encodings-%d.db" % args.rows)
+    os.environ["RATELIMIT_DISABLED"] = "1"
+    seed(args.rows)
+    sys.path.insert(0, SRC)
+    from app import create_app
+    app = create_app("api")
+    from compression import compression
+    from cache import response_cache
+
+    client = app.test_client()
+    path = "/characters?limit=%d" % args.page
+    body = client.get(path, headers={"Accept-Encoding": "identity"}).get_data()
+    print("%-12s %9d bytes" % ("identity", len(body)))
+    levels = [("gzip", level) for level in (1, 6, 9)]
+    if "br" in compression.encodings():
+        levels += [("br", level) for level in (1, 5, 6, 11)]
+    for encoding, level in levels:
+        compression.level = compression.brotli_level = level
+        seconds = best_of(lambda: compression.compress(body, encoding), args.repeat)
+        print("%-12s %9d bytes  %7.2fms" % ("%s:%d" % (encoding, level),
+                                           len(compression.compress(body, encoding)), seconds * 1000))
+    compression.level, compression.brotli_level = 6, 5
+
+    encoding = compression.encodings()[0]
+    headers = {"Accept-Encoding": encoding}
+    client.get(path, headers=headers)
+    stored = best_of(lambda: client.get(path, headers=headers), args.repeat)
+    key = [key for key in response_cache.backend._entries if key.endswith("|" + encoding)][0]
+
+    def without_stored_copy():
+        response_cache.backend.delete(key)
+        client.get(path, headers=headers)
+    recompressed = best_of(without_stored_copy, args.repeat)
+    print("cache hit, stored %s copy      %7.2fms" % (encoding, stored * 1000))
+    print("cache hit, compressed per hit  %7.2fms" % (recompressed * 1000))
+
+
+if __name__ == "__main__":
+    main()
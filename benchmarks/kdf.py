@@ -0,0 +1,56 @@
+"""
+Pick the password hashing cost: times one hash per candidate PASSWORD_HASH_METHOD
+(werkzeug format) and recommends the most expensive one whose verification still
+fits the login latency budget on this machine.
+
+    python benchmarks/kdf.py --budget-ms 250
+    PASSWORD_HASH_METHOD=scrypt:65536:8:1 flask run ...
+"""
+import argparse
+import time
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+CANDIDATES = [
+    "scrypt:16384:8:1",
+    "scrypt:32768:8:1",
+    "scrypt:65536:8:1",
+    "scrypt:131072:8:1",
+    "pbkdf2:sha256:600000",
+    "pbkdf2:sha256:1000000",
+]
+
+
+def verify_seconds(method, repeat):
+    stored = generate_password_hash("correct horse battery staple", method=method)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        check_password_hash(stored, "correct horse battery staple")
+        timings.append(time.perf_counter() - started)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, default=250, help="time login may spend verifying the password")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--method", action="append", help="candidate to time instead of the defaults, repeatable")
+    args = parser.parse_args()
+
+    within = []
+    for method in args.method or CANDIDATES:
+        seconds = verify_seconds(method, args.repeat)
+        print("%-25s %8.1fms%s" % (method, seconds * 1000, "" if seconds * 1000 <= args.budget_ms else "  over budget"))
+        if seconds * 1000 <= args.budget_ms:
+            within.append((seconds, method))
+    # scrypt is memory hard, prefer it to pbkdf2 whenever one fits
+    best = max([item for item in within if item[1].startswith("scrypt")] or within, default=None)
+    if best is None:
+        print("no candidate fits in %.0fms" % args.budget_ms)
+    else:
+        print("PASSWORD_HASH_METHOD=%s" % best[1])
+
+
+if __name__ == "__main__":
+    main()
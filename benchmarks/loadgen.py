@@ -0,0 +1,79 @@
+"""
+Closed-loop HTTP load generator: `concurrency` threads, each with its own keep-alive
+connection, send requests back to back for `duration` seconds.
+"""
+import http.client
+import statistics
+import threading
+import time
+
+
+def summarize(latencies, duration=None):
+    """p50/p95/p99 in milliseconds (and throughput when `duration` is given)"""
+    latencies = sorted(latencies)
+    if len(latencies) > 1:
+        quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    else:
+        quantiles = latencies * 99 or [0] * 99
+    summary = {
+        "requests": len(latencies),
+        "p50_ms": round(quantiles[49] * 1000, 3),
+        "p95_ms": round(quantiles[94] * 1000, 3),
+        "p99_ms": round(quantiles[98] * 1000, 3),
+    }
+    if duration:
+        summary["requests_per_second"] = round(len(latencies) / duration, 1)
+    return summary
+
+
+def wait_until_up(port, path="/", timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", path)
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server on port %d did not start" % port)
+
+
+def drive(port, paths, concurrency, duration):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def worker(offset):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        index = offset
+        local_latencies = []
+        local_errors = 0
+        while time.perf_counter() < stop_at:
+            path = paths[index % len(paths)]
+            index += 1
+            started = time.perf_counter()
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                response.read()
+            except OSError:
+                local_errors += 1
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                continue
+            if response.status >= 500:
+                local_errors += 1
+            local_latencies.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summary = summarize(latencies, duration)
+    summary["errors"] = sum(errors)
+    return summary
@@ -0,0 +1,86 @@
+"""
+Check that the filtered and sorted list queries, and the listing of a user's
+favourites, are served by an index.
+
+Every case below goes through the real endpoint; the SQL it sends is captured and
+EXPLAINed. Exits non-zero when a plan falls back to a full table scan
+(SQLite "SCAN <table>" without an index, PostgreSQL "Seq Scan").
+
+    python benchmarks/query_plans.py
+    DATABASE_URL=postgresql://... python benchmarks/query_plans.py --scale 100k
+"""
+import argparse
+import os
+import sys
+
+from seed import SCALES, SRC, seed
+
+CASES = [
+    "/characters?race=Wookiee",
+    "/characters?homeworld=Naboo",
+    "/characters?name_prefix=Character%2012",
+    "/characters?sort=name",
+    "/characters?sort=-name",
+    "/planets?min_population=1000&max_population=50000",
+    "/planets?max_average_temp=-30",
+    "/planets?sort=population",
+    "/planets?sort=-averageTemp",
+    "/planets?sort=name",
+    "/vehicles?min_length=10&max_length=20",
+    "/vehicles?min_crew_size=35",
+    "/vehicles?sort=crewSize",
+    "/vehicles?sort=-length",
+    "/users/favourites/1",
+]
+
+
+def explain(connection, statement, parameters):
+    if connection.dialect.name == "sqlite":
+        rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+        plan = [row[-1] for row in rows]
+        full_scans = [line for line in plan if line.startswith("SCAN") and "INDEX" not in line]
+    else:
+        # the planner may prefer a seq scan on a small table, we only check that an index can serve the query
+        connection.exec_driver_sql("SET enable_seqscan = off")
+        plan = [row[0] for row in connection.exec_driver_sql("EXPLAIN " + statement, parameters).fetchall()]
+        connection.exec_driver_sql("SET enable_seqscan = on")
+        full_scans = [line for line in plan if "Seq Scan" in line]
+    return plan, full_scans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    args = parser.parse_args()
+
+    os.environ.setdefault("DATABASE_URL", "sqlite:////tmp/swapi-bench-%s.db" % args.scale)
+    os.environ["CACHE_DISABLED"] = "1"
+    seed(SCALES[args.scale])
+    sys.path.insert(0, SRC)
+    from sqlalchemy import event
+    from app import create_app
+    app = create_app("api")
+    from models import db
+
+    failures = 0
+    with app.app_context():
+        captured = []
+        event.listen(db.engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, parameters, context, executemany: captured.append((statement, parameters)))
+        client = app.test_client()
+        for path in CASES:
+            captured.clear()
+            client.get(path)
+            statement, parameters = captured[-1]
+            with db.engine.connect() as connection:
+                plan, full_scans = explain(connection, statement, parameters)
+            status = "FULL SCAN" if full_scans else "ok"
+            failures += bool(full_scans)
+            print("%-9s %s" % (status, path))
+            for line in plan:
+                print("          %s" % line)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Benchmark suite for the REST endpoints.
+
+Seeds a database at the chosen scale, then drives every GET route (plus a few
+write scenarios) in-process with the Flask test client, and optionally over HTTP
+against a gunicorn server with the concurrent load generator. Reports p50/p95/p99
+latency, throughput and peak RSS per endpoint and saves the results as JSON.
+
+    python benchmarks/run.py --scale 100k --http
+    python benchmarks/run.py --scale 100k --baseline benchmarks/results/<earlier run>.json
+
+DATABASE_URL selects the database (PostgreSQL or SQLite); by default every scale
+gets its own SQLite file in /tmp so seeding only happens once.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import re
+import resource
+import signal
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(os.path.dirname(BENCHMARKS), "src")
+RESULTS = os.path.join(BENCHMARKS, "results")
+sys.path.insert(0, SRC)
+
+from loadgen import drive, summarize, wait_until_up  # noqa: E402
+from seed import SCALES, seed  # noqa: E402
+
+SKIPPED_PREFIXES = ("/admin", "/static", "/export", "/metrics")
+# routes protected by a token or only meaningful with a body are driven through SCENARIOS
+SKIPPED_ENDPOINTS = ("protected", "valid_token")
+# (name, method, path, json body) for routes that are not plain GETs
+SCENARIOS = [
+    ("add favourite planet", "POST", "/favourites/planets/{n}", {"user_id": 1}),
+    ("remove favourite planet", "DELETE", "/favourites/planets/{n}", {"user_id": 1}),
+    ("batch favourites", "POST", "/favourites/batch",
+     {"user_id": 2, "add": [{"kind": "characters", "id": 1}, {"kind": "vehicles", "id": 2}],
+      "remove": [{"kind": "characters", "id": 1}]}),
+]
+# query strings for routes that answer 400 without one; /search gets a short
+# prefix, single words, a long multi-word term and a misspelling (trigram match)
+ROUTE_QUERIES = {
+    "search": ["q=ho", "q=Tatooine", "q=Character+4242", "q=Human+from+Coruscant+Wookiee", "q=Wookie"],
+}
+REGRESSION_THRESHOLD = 0.10
+
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return usage // 1024 if platform.system() == "Darwin" else usage
+
+
+def get_routes(app):
+    """One concrete GET path per route of the app, with path arguments set to existing ids"""
+    routes = []
+    for rule in app.url_map.iter_rules():
+        if "GET" not in rule.methods or rule.endpoint in SKIPPED_ENDPOINTS or rule.rule.startswith(SKIPPED_PREFIXES):
+            continue
+        path = re.sub(r"<int:[^>]+>", "1", rule.rule)
+        path = re.sub(r"<[^>]+>", "characters", path)
+        for query in ROUTE_QUERIES.get(rule.endpoint, [None]):
+            routes.append((rule.endpoint, "GET", path if query is None else "%s?%s" % (path, query), None))
+    return sorted(routes)
+
+
+def bench_in_process(app, iterations):
+    client = app.test_client()
+    results = {}
+    scenarios = get_routes(app) + SCENARIOS
+    for name, method, path, body in scenarios:
+        for _ in range(min(10, iterations)):  # warm up
+            client.open(path.format(n=1), method=method, json=body)
+        latencies = []
+        statuses = {}
+        started = time.perf_counter()
+        for n in range(iterations):
+            request_started = time.perf_counter()
+            response = client.open(path.format(n=n % 100 + 1), method=method, json=body)
+            response.get_data()
+            latencies.append(time.perf_counter() - request_started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        summary = summarize(latencies, time.perf_counter() - started)
+        summary["statuses"] = statuses
+        summary["peak_rss_kb"] = peak_rss_kb()
+        results["%s %s" % (method, path)] = summary
+    return results
+
+
+def bench_http(app, concurrency, duration, workers, port):
+    results = {}
+    paths = [path for name, method, path, body in get_routes(app)]
+    server = subprocess.Popen(
+        ["gunicorn", "wsgi:application", "--chdir", SRC, "--workers", str(workers), "--bind", "127.0.0.1:%d" % port],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(port)
+        for path in paths:
+            results["GET %s" % path] = drive(port, [path], concurrency, duration)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    results["server_peak_rss_kb"] = children // 1024 if platform.system() == "Darwin" else children
+    return results
+
+
+def compare(results, baseline):
+    """Prints p50/p99 changes against a baseline run, returns the regressed endpoints"""
+    regressions = []
+    for section in ("in_process", "http"):
+        for endpoint, current in results.get(section, {}).items():
+            previous = baseline.get(section, {}).get(endpoint)
+            if not isinstance(current, dict) or not isinstance(previous, dict):
+                continue
+            changes = []
+            for metric in ("p50_ms", "p99_ms"):
+                if previous[metric]:
+                    change = (current[metric] - previous[metric]) / previous[metric]
+                    changes.append("%s %+.1f%%" % (metric, change * 100))
+                    if change > REGRESSION_THRESHOLD:
+                        regressions.append((section, endpoint, metric))
+            print("%-10s %-45s %s" % (section, endpoint, "  ".join(changes)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--iterations", type=int, default=200, help="requests per endpoint in-process")
+    parser.add_argument("--http", action="store_true", help="also load test a gunicorn server over HTTP")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5, help="seconds of HTTP load per endpoint")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--with-cache", action="store_true", help="keep the response cache on")
+    parser.add_argument("--output", help="where to write the JSON results")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    os.environ.setdefault("DATABASE_URL", "sqlite:////tmp/swapi-bench-%s.db" % args.scale)
+    if not args.with_cache:
+        os.environ["CACHE_DISABLED"] = "1"
+    # the write scenarios hammer one user's favourites far above the per-client limit
+    os.environ.setdefault("RATELIMIT_DISABLED", "1")
+    counts = seed(SCALES[args.scale])
+    from app import create_app
+    app = create_app("api")
+
+    results = {
+        "meta": {
+            "date": datetime.now(timezone.utc).isoformat(),
+            "scale": args.scale,
+            "rows": counts,
+            "database": app.config["SQLALCHEMY_DATABASE_URI"].split("://")[0],
+            "python": platform.python_version(),
+            "cache": args.with_cache,
+        },
+    }
+    # handlers still print() their payloads, keep that out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        results["in_process"] = bench_in_process(app, args.iterations)
+    if args.http:
+        results["http"] = bench_http(app, args.concurrency, args.duration, args.workers, args.port)
+
+    output = args.output or os.path.join(RESULTS, "%s-%s.json" % (args.scale, time.strftime("%Y%m%d-%H%M%S")))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+    for endpoint, summary in results["in_process"].items():
+        print("%-45s p50 %8.3fms  p95 %8.3fms  p99 %8.3fms  %8.1f req/s" % (
+            endpoint, summary["p50_ms"], summary["p95_ms"], summary["p99_ms"], summary["requests_per_second"]))
+    for endpoint, summary in results.get("http", {}).items():
+        if isinstance(summary, dict):
+            print("http %-40s p50 %8.3fms  p95 %8.3fms  p99 %8.3fms  %8.1f req/s  %d errors" % (
+                endpoint, summary["p50_ms"], summary["p95_ms"], summary["p99_ms"],
+                summary["requests_per_second"], summary["errors"]))
+    print("results written to %s" % output)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file))
+        if regressions:
+            print("regressions over %d%%: %s" % (REGRESSION_THRESHOLD * 100, regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Seed a database with synthetic characters, planets, vehicles, users and favourites.
+
+    DATABASE_URL=sqlite:////tmp/bench.db python benchmarks/seed.py --scale 100k
+"""
+import argparse
+import os
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+SCALES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+HOMEWORLDS = ["Tatooine", "Naboo", "Coruscant", "Kashyyyk", "Endor", "Hoth", "Dagobah", "Alderaan"]
+RACES = ["Human", "Wookiee", "Droid", "Twi'lek", "Rodian", "Ewok"]
+
+
+def batches(total, batch_size, make_row):
+    for start in range(0, total, batch_size):
+        yield [make_row(i) for i in range(start, min(start + batch_size, total))]
+
+
+def seed(rows, users=100, favourites_per_user=10, batch_size=10000):
+    """Creates the tables and fills them unless they already hold data. Returns the row counts"""
+    if SRC not in sys.path:
+        sys.path.insert(0, SRC)
+    from app import create_app
+    app = create_app("api")
+    from models import db, Characters, Planets, Vehicles, User, Favourites
+    with app.app_context():
+        db.create_all()
+        if db.session.query(Characters.id).first() is None:
+            tables = [
+                (Characters, lambda i: {"name": "Character %d" % i, "race": RACES[i % len(RACES)],
+                                        "homeworld": HOMEWORLDS[i % len(HOMEWORLDS)]}),
+                (Planets, lambda i: {"name": "Planet %d" % i, "population": i * 1000, "averageTemp": i % 120 - 40}),
+                (Vehicles, lambda i: {"name": "Vehicle %d" % i, "length": i % 500, "crewSize": i % 40}),
+            ]
+            for model, make_row in tables:
+                for batch in batches(rows, batch_size, make_row):
+                    db.session.execute(db.insert(model), batch)
+                    db.session.commit()
+            db.session.execute(db.insert(User), [
+                {"userName": "user%d" % i, "email": "user%d@example.com" % i, "password": "password"} for i in range(users)])
+            favourites = []
+            for user_id in range(1, users + 1):
+                for n in range(favourites_per_user):
+                    target = (user_id * favourites_per_user + n) % rows + 1
+                    kind = ("characters", "planets", "vehicles")[n % 3]
+                    favourites.append({"user_id": user_id, "kind": kind, "target_id": target})
+            db.session.execute(db.insert(Favourites), favourites)
+            db.session.commit()
+        return {model.__tablename__: db.session.query(model).count()
+                for model in (Characters, Planets, Vehicles, User, Favourites)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", choices=SCALES, default="1k")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+    print(seed(SCALES[args.scale], batch_size=args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Compare the list serialization paths on one page of characters:
+
+- orm: Model.query ... .all() + serialize() per object + stdlib json
+- projection: only the serialized columns as tuples + serialize_row() + stdlib json
+- projection+orjson: the same rows encoded by the app's JSON provider
+
+    python benchmarks/serialization.py --rows 100000 --page 500
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from seed import SRC, seed
+
+
+def best_of(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--page", type=int, default=500, help="rows per list response")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ.setdefault("DATABASE_URL", "sqlite:////tmp/swapi-bench-serialization-%d.db" % args.rows)
+    seed(args.rows)
+    sys.path.insert(0, SRC)
+    from app import create_app
+    app = create_app("api")
+    from models import Characters
+    import json_provider
+
+    def orm():
+        rows = Characters.query.order_by(Characters.id).limit(args.page).all()
+        return json.dumps({"results": [row.serialize() for row in rows]})
+
+    def projection():
+        rows = (Characters.query.with_entities(*Characters.serialized_columns())
+                .order_by(Characters.id).limit(args.page).all())
+        return [Characters.serialize_row(row) for row in rows]
+
+    with app.app_context():
+        timings = {
+            "orm": best_of(orm, args.repeat),
+            "projection": best_of(lambda: json.dumps({"results": projection()}), args.repeat),
+        }
+        if json_provider.orjson is not None:
+            timings["projection+orjson"] = best_of(lambda: app.json.dumps({"results": projection()}), args.repeat)
+
+    baseline = timings["orm"]
+    for name, seconds in timings.items():
+        print("%-20s %8.3fms  %5.2fx" % (name, seconds * 1000, baseline / seconds))
+
+
+if __name__ == "__main__":
+    main()
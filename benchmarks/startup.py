@@ -0,0 +1,83 @@
+"""
+Worker startup cost per process role: time to import the app module, to build the
+app with create_app(role) and to answer the first request, each measured in a
+fresh interpreter (median of --runs). With --http also the time from launching
+gunicorn to its first successful response.
+
+    python benchmarks/startup.py --runs 5 --http
+"""
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+from loadgen import wait_until_up
+from seed import SRC, seed
+
+# role -> path of its first request (None: the role serves no requests)
+ROLES = {"api": "/characters/1", "admin": "/admin/", "migrate": None, "all": "/characters/1"}
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app(sys.argv[1])
+created = time.perf_counter()
+if sys.argv[2]:
+    flask_app.test_client().get(sys.argv[2])
+served = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "create_app_ms": (created - imported) * 1000,
+                  "first_request_ms": (served - created) * 1000, "total_ms": (served - started) * 1000}))
+"""
+
+
+def probe(role, path):
+    output = subprocess.run([sys.executable, "-c", PROBE, role, path or ""], cwd=SRC, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def gunicorn_boot(port, workers):
+    started = time.perf_counter()
+    server = subprocess.Popen(["gunicorn", "wsgi:application", "--chdir", SRC, "--workers", str(workers),
+                               "--bind", "127.0.0.1:%d" % port], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(port, "/characters/1")
+        return (time.perf_counter() - started) * 1000
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--role", action="append", choices=ROLES, help="role to measure, repeatable (default: all of them)")
+    parser.add_argument("--http", action="store_true", help="also time gunicorn from launch to first response")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8767)
+    args = parser.parse_args()
+
+    os.environ.setdefault("DATABASE_URL", "sqlite:////tmp/swapi-bench-startup.db")
+    seed(1000)
+    results = {}
+    for role in args.role or ROLES:
+        runs = [probe(role, ROLES[role]) for _ in range(args.runs)]
+        results[role] = {metric: round(statistics.median(run[metric] for run in runs), 1) for metric in runs[0]}
+        print("%-8s import %7.1fms  create_app %7.1fms  first request %7.1fms  total %7.1fms" % (
+            role, results[role]["import_ms"], results[role]["create_app_ms"],
+            results[role]["first_request_ms"], results[role]["total_ms"]))
+    if args.http:
+        boots = [gunicorn_boot(args.port, args.workers) for _ in range(args.runs)]
+        results["gunicorn_first_response_ms"] = round(statistics.median(boots), 1)
+        print("gunicorn launch to first response %7.1fms" % results["gunicorn_first_response_ms"])
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
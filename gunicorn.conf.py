@@ -0,0 +1,19 @@
+# Picked up by gunicorn from the working directory (see Procfile). Only matters
+# when PROMETHEUS_MULTIPROC_DIR is set, see src/metrics.py
+import glob
+import os
+
+
+def on_starting(server):
+    # values of a previous run would be added to this one's
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "metrics_*.json")):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from metrics import mark_process_dead
+        mark_process_dead(worker.pid)
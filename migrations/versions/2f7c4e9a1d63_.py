@@ -0,0 +1,42 @@
+"""index catalogue filter and sort columns
+
+Revision ID: 2f7c4e9a1d63
+Revises: 8d3f61a0c2b9
+Create Date: 2026-10-18 14:05:52.918377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f7c4e9a1d63'
+down_revision = '8d3f61a0c2b9'
+branch_labels = None
+depends_on = None
+
+# (table, column): every index is (column, id) so filtered and sorted pages are
+# read in keyset order straight from the index
+INDEXED_COLUMNS = [
+    ('characters', 'name'),
+    ('characters', 'race'),
+    ('characters', 'homeworld'),
+    ('planets', 'name'),
+    ('planets', 'population'),
+    ('planets', 'averageTemp'),
+    ('vehicles', 'name'),
+    ('vehicles', 'length'),
+    ('vehicles', 'crewSize'),
+]
+
+
+def upgrade():
+    for table, column in INDEXED_COLUMNS:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.create_index('ix_%s_%s_id' % (table, column), [column, 'id'], unique=False)
+
+
+def downgrade():
+    for table, column in reversed(INDEXED_COLUMNS):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_index('ix_%s_%s_id' % (table, column))
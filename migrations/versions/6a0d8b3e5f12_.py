@@ -0,0 +1,41 @@
+"""trigram search indexes on PostgreSQL
+
+Revision ID: 6a0d8b3e5f12
+Revises: 2f7c4e9a1d63
+Create Date: 2026-10-18 16:22:40.117302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a0d8b3e5f12'
+down_revision = '2f7c4e9a1d63'
+branch_labels = None
+depends_on = None
+
+# columns searched by GET /search; other databases use the in-process index in search.py
+SEARCHED_COLUMNS = [
+    ('characters', 'name'),
+    ('characters', 'race'),
+    ('characters', 'homeworld'),
+    ('planets', 'name'),
+    ('vehicles', 'name'),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table, column in SEARCHED_COLUMNS:
+        op.create_index('ix_%s_%s_trgm' % (table, column), table, [column], unique=False,
+                        postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table, column in reversed(SEARCHED_COLUMNS):
+        op.drop_index('ix_%s_%s_trgm' % (table, column), table_name=table)
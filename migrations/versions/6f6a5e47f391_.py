@@ -0,0 +1,61 @@
+"""favourites: fill kind and target_id from the per-kind columns
+
+Revision ID: 6f6a5e47f391
+Revises: 4e8a1c6f3b27
+Create Date: 2026-10-18 19:44:26.581903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f6a5e47f391'
+down_revision = '4e8a1c6f3b27'
+branch_labels = None
+depends_on = None
+
+# rows copied per UPDATE, each batch commits on its own so no statement holds
+# locks on (or rewrites) the whole table
+BATCH_SIZE = 5000
+
+# kind -> old target column
+KIND_COLUMNS = {
+    'characters': 'favouriteCharacters_id',
+    'planets': 'favouritePlanets_id',
+    'vehicles': 'favouriteVehicles_id',
+}
+
+favourites = sa.table('favourites',
+    sa.column('id', sa.Integer),
+    sa.column('kind', sa.String),
+    sa.column('target_id', sa.Integer),
+    *[sa.column(column, sa.Integer) for column in KIND_COLUMNS.values()]
+)
+
+
+def in_batches(update):
+    """Runs `update(low, high)` over consecutive id ranges of BATCH_SIZE rows"""
+    bind = op.get_bind()
+    low, high = bind.execute(sa.select(sa.func.min(favourites.c.id), sa.func.max(favourites.c.id))).one()
+    if low is None:
+        return
+    with op.get_context().autocommit_block():
+        for start in range(low, high + 1, BATCH_SIZE):
+            op.execute(update(start, start + BATCH_SIZE))
+
+
+def upgrade():
+    # only rows not filled yet: a backfill that stopped halfway picks up where it was
+    kind = sa.case(*[(favourites.c[column].is_not(None), kind) for kind, column in KIND_COLUMNS.items()])
+    target_id = sa.func.coalesce(*[favourites.c[column] for column in KIND_COLUMNS.values()])
+    in_batches(lambda low, high: favourites.update()
+               .where(favourites.c.id >= low, favourites.c.id < high, favourites.c.kind.is_(None))
+               .values(kind=kind, target_id=target_id))
+    # rows that never pointed to anything
+    op.execute(favourites.delete().where(favourites.c.kind.is_(None)))
+
+
+def downgrade():
+    # the per-kind columns still hold every favourite, nothing to undo
+    pass
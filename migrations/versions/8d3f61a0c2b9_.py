@@ -0,0 +1,46 @@
+"""unique favourites per user and target
+
+Revision ID: 8d3f61a0c2b9
+Revises: 5b1e9c2d7f40
+Create Date: 2026-10-18 10:41:07.553120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3f61a0c2b9'
+down_revision = '5b1e9c2d7f40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # drop duplicates created by the old check-then-insert handlers, keeping the oldest row
+    favourites = sa.table('favourites',
+        sa.column('id', sa.Integer),
+        sa.column('user_id', sa.Integer),
+        sa.column('favouritePlanets_id', sa.Integer),
+        sa.column('favouriteCharacters_id', sa.Integer),
+        sa.column('favouriteVehicles_id', sa.Integer)
+    )
+    keep = sa.select(sa.func.min(favourites.c.id).label('id')).group_by(
+        favourites.c.user_id,
+        favourites.c.favouritePlanets_id,
+        favourites.c.favouriteCharacters_id,
+        favourites.c.favouriteVehicles_id
+    ).subquery()
+    op.execute(favourites.delete().where(favourites.c.id.not_in(sa.select(keep.c.id))))
+
+    with op.batch_alter_table('favourites', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_favourites_user_planet', ['user_id', 'favouritePlanets_id'])
+        batch_op.create_unique_constraint('uq_favourites_user_character', ['user_id', 'favouriteCharacters_id'])
+        batch_op.create_unique_constraint('uq_favourites_user_vehicle', ['user_id', 'favouriteVehicles_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('favourites', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_favourites_user_vehicle', type_='unique')
+        batch_op.drop_constraint('uq_favourites_user_character', type_='unique')
+        batch_op.drop_constraint('uq_favourites_user_planet', type_='unique')
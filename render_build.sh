@@ -8,4 +8,4 @@ set -o errexit
 
 pipenv install
 
-pipenv run upgrade
\ No newline at end of file
+APP_ROLE=migrate pipenv run upgrade
\ No newline at end of file
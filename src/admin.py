@@ -1,28 +1,228 @@
+"""
+Flask-Admin views that stay fast on large tables:
+
+- the row count is exact up to ADMIN_EXACT_COUNT_LIMIT rows; above it the list
+  shows the planner's estimate (PostgreSQL pg_class, MySQL information_schema,
+  max(id) elsewhere), and a search or filter counts at most that many matches
+- search and filters only use indexed columns: search matches a prefix of the
+  column (a range on its B-tree index), or, on PostgreSQL, any part of the
+  columns that have a pg_trgm index (see search.py)
+- pages are ordered by (sort column, id) and the next page starts after the last
+  row of the previous one, which is remembered for ADMIN_PAGE_BOUNDARY_TTL
+  seconds; only a jump to a page never reached that way falls back to OFFSET
+- favourites are listed with their user and target joined into the same SELECT
+- GET requests read from a replica when DATABASE_REPLICA_URLS is set (replicas.py)
+"""
 import os
 from flask_admin import Admin
-from models import db, User, Planets, Characters, Vehicles, Favourites
 from flask_admin.contrib.sqla import ModelView
+from flask_admin.contrib.sqla.filters import FilterEqual, IntEqualFilter, IntGreaterFilter, IntSmallerFilter
+from sqlalchemy import and_, or_, text
+from wtforms import PasswordField
+from wtforms.validators import ValidationError
+from auth import hash_password
+from cache import LocalCache
+from models import db, User, Planets, Characters, Vehicles, Favourites
+from replicas import setup_replicas
+from search import SEARCHABLE
+from utils import prefix_range
+
+EXACT_COUNT_LIMIT = int(os.getenv("ADMIN_EXACT_COUNT_LIMIT", 10000))
+PAGE_BOUNDARY_TTL = int(os.getenv("ADMIN_PAGE_BOUNDARY_TTL", 300))
+
+# columns with a pg_trgm index, where ILIKE '%term%' is served by the index
+TRIGRAM_COLUMNS = {(model.__tablename__, column) for model, columns in SEARCHABLE.values() for column in columns}
+MIN_TRIGRAM_SEARCH = 3
+
+# (view, sort, search, filters, page size, page) -> sort key of the last row of that page
+page_boundaries = LocalCache(max_entries=10000, ttl=PAGE_BOUNDARY_TTL)
+
+
+def estimated_count(session, table):
+    """The planner's idea of the number of rows in `table`, None when it has none"""
+    bind = session.get_bind()
+    if bind.dialect.name == "postgresql":
+        estimate = session.execute(text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:table)"),
+                                   {"table": '"%s"' % table.name}).scalar()
+    elif bind.dialect.name in ("mysql", "mariadb"):
+        estimate = session.execute(text("SELECT TABLE_ROWS FROM information_schema.TABLES "
+                                        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"),
+                                   {"table": table.name}).scalar()
+    else:
+        # ids are handed out in order, the highest one is an upper bound read off the primary key
+        estimate = session.execute(db.select(db.func.max(table.c.id))).scalar()
+    # reltuples is -1 on a table PostgreSQL has not analyzed yet
+    return int(estimate) if estimate is not None and estimate >= 0 else None
+
+
+class ScalableModelView(ModelView):
+    # the counting is done by get_list below, not by Flask-Admin's COUNT(*)
+    simple_list_pager = True
+    column_display_pk = True
+    can_set_page_size = False
+
+    def search_placeholder(self):
+        if not self._search_fields:
+            return super().search_placeholder()
+        return "Starts with (%s)" % ", ".join(str(field.key) for field, path in self._search_fields)
+
+    def _apply_search(self, query, count_query, joins, count_joins, search):
+        term = search.strip()
+        if not term:
+            return query, count_query, joins, count_joins
+        postgresql = self.session.get_bind().dialect.name == "postgresql"
+        clauses = []
+        for field, path in self._search_fields:
+            if postgresql and len(term) >= MIN_TRIGRAM_SEARCH and (field.table.name, field.key) in TRIGRAM_COLUMNS:
+                escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                clauses.append(field.ilike("%" + escaped + "%", escape="\\"))
+            else:
+                clauses.append(prefix_range(field, term))
+        return query.filter(or_(*clauses)), count_query, joins, count_joins
+
+    def count_rows(self, query, narrowed):
+        if not narrowed:
+            estimate = estimated_count(self.session, self.model.__table__)
+            if estimate is not None and estimate > EXACT_COUNT_LIMIT:
+                return estimate
+            return self.session.query(db.func.count()).select_from(self.model).scalar()
+        # a search or a filter: count the matches up to EXACT_COUNT_LIMIT
+        matches = (query.enable_eagerloads(False).with_entities(self.model.id).order_by(None)
+                   .limit(EXACT_COUNT_LIMIT).subquery())
+        return self.session.query(db.func.count()).select_from(matches).scalar()
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        if page_size is None:
+            page_size = self.page_size
+        # search, filters and eager loads from Flask-Admin; no order, no limit yet
+        count, query = super().get_list(0, None, False, search, filters, execute=False, page_size=0)
+        count = self.count_rows(query, bool(search) or bool(filters))
+
+        key_columns = [self.model.id]
+        if sort_column is not None:
+            key_columns.insert(0, getattr(self.model, sort_column))
+        query = query.order_by(*[column.desc() if sort_desc else column for column in key_columns])
+        if not page_size:
+            return count, query.all() if execute else query
+
+        def boundary_key(number):
+            return "%s|%s|%s|%s|%r|%d|%d" % (self.endpoint, sort_column, sort_desc, search, filters, page_size, number)
+
+        after = page_boundaries.get(boundary_key(page - 1)) if page else None
+        if after is not None:
+            query = query.filter(self.after(key_columns, after, sort_desc))
+        elif page:
+            query = query.offset(page * page_size)
+        query = query.limit(page_size)
+        if not execute:
+            return count, query
+        rows = query.all()
+        if rows:
+            last = tuple(getattr(rows[-1], column.key) for column in key_columns)
+            if None not in last:
+                page_boundaries.set(boundary_key(page), last)
+        return count, rows
+
+    @staticmethod
+    def after(key_columns, values, descending):
+        """Rows that come after `values` in the (sort column, id) order"""
+        if len(key_columns) == 1:
+            return key_columns[0] < values[0] if descending else key_columns[0] > values[0]
+        (column, id_column), (value, last_id) = key_columns, values
+        if descending:
+            return or_(column < value, and_(column == value, id_column < last_id))
+        return or_(column > value, and_(column == value, id_column > last_id))
+
+
+class UserView(ScalableModelView):
+    column_exclude_list = ('password',)
+    column_searchable_list = ('userName',)
+    column_sortable_list = ('id', 'userName')
+    column_filters = (FilterEqual(User.userName, 'User name'),)
+    # the hash is never shown; a password typed here is hashed like at /signup
+    form_excluded_columns = ('password', 'token_version')
+    form_extra_fields = {'new_password': PasswordField('New password')}
+
+    def on_model_change(self, form, model, is_created):
+        if form.new_password.data:
+            model.password = hash_password(form.new_password.data)
+            if not is_created:
+                # tokens issued with the old password stop working
+                model.token_version = (model.token_version or 0) + 1
+        elif is_created:
+            raise ValidationError('A new user needs a password')
+
+
+class CharactersView(ScalableModelView):
+    column_searchable_list = ('name', 'race', 'homeworld')
+    column_sortable_list = ('id', 'name', 'race', 'homeworld')
+    column_filters = (
+        FilterEqual(Characters.race, 'Race'),
+        FilterEqual(Characters.homeworld, 'Homeworld'),
+    )
+
+
+class PlanetsView(ScalableModelView):
+    column_searchable_list = ('name',)
+    column_sortable_list = ('id', 'name', 'population', 'averageTemp')
+    column_filters = (
+        IntGreaterFilter(Planets.population, 'Population'),
+        IntSmallerFilter(Planets.population, 'Population'),
+        IntGreaterFilter(Planets.averageTemp, 'Average temp'),
+        IntSmallerFilter(Planets.averageTemp, 'Average temp'),
+    )
+
+
+class VehiclesView(ScalableModelView):
+    column_searchable_list = ('name',)
+    column_sortable_list = ('id', 'name', 'length', 'crewSize')
+    column_filters = (
+        IntGreaterFilter(Vehicles.length, 'Length'),
+        IntSmallerFilter(Vehicles.length, 'Length'),
+        IntGreaterFilter(Vehicles.crewSize, 'Crew size'),
+        IntSmallerFilter(Vehicles.crewSize, 'Crew size'),
+    )
+
+
+def target_name(view, context, model, name):
+    target = getattr(model, model.kind, None)
+    return "%s (#%d)" % (target.name if target else "missing", model.target_id)
+
+
+#Special view for favourite table
+class favouritesView(ScalableModelView):
+    column_list = ('id', 'user', 'kind', 'target_id')
+    column_labels = {'target_id': 'Target'}
+    column_formatters = {
+        'user': lambda view, context, model, name: "%s (#%d)" % (model.user.userName, model.user_id),
+        'target_id': target_name,
+    }
+    column_sortable_list = ('id',)
+    column_filters = (IntEqualFilter(Favourites.user_id, 'User id'),)
+    form_columns = ('user_id', 'kind', 'target_id')
+    form_choices = {'kind': [('characters', 'characters'), ('planets', 'planets'), ('vehicles', 'vehicles')]}
+
+    def get_query(self):
+        # the user and whichever target the row points to come in the same SELECT
+        return super().get_query().options(db.joinedload(Favourites.user), *Favourites.eager_targets())
+
 
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'sandstone'
+    if "replicas" not in app.extensions:
+        # admin pages are GETs too: browse on a replica, edit on the primary
+        setup_replicas(app)
     admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
 
-    
     # Add your models here, for example this is how we add a the User model to the admin
-    admin.add_view(ModelView(User, db.session))
-    
-    admin.add_view(ModelView(Characters, db.session))
-    admin.add_view(ModelView(Planets, db.session))
-    admin.add_view(ModelView(Vehicles, db.session))
-
-    # You can duplicate that line to add mew models
-    # admin.add_view(ModelView(YourModelName, db.session))
-
-    #Special view for favourite table
-    class favouritesView(ModelView):
-        column_list = ('favouriteCharacters_id', 'favouritePlanets_id', 'favouriteVehicles_id', 'user_id')
-        form_columns = ('favouriteCharacters_id', 'favouritePlanets_id', 'favouriteVehicles_id', 'user_id')    
-
-# Add your models here: favourites (ForeignKey)    
-    admin.add_view(favouritesView(Favourites, db.session))
\ No newline at end of file
+    admin.add_view(UserView(User, db.session))
+
+    admin.add_view(CharactersView(Characters, db.session))
+    admin.add_view(PlanetsView(Planets, db.session))
+    admin.add_view(VehiclesView(Vehicles, db.session))
+
+    # You can duplicate that line to add mew models, subclassing ScalableModelView
+    # admin.add_view(ScalableModelView(YourModelName, db.session))
+
+    admin.add_view(favouritesView(Favourites, db.session))
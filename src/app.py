@@ -1,77 +1,321 @@
 """
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
-"""
-import os
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
-from flask_cors import CORS
-from utils import APIException, generate_sitemap
-from admin import setup_admin
-from models import db, User, Planets, Characters, Vehicles, Favourites
-from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required, JWTManager
-
 
-app = Flask(__name__)
-app.url_map.strict_slashes = False
+create_app(role) builds the Flask app for one process role, so every process only
+imports and wires what it serves:
 
-db_url = os.getenv("DATABASE_URL")
-if db_url is not None:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+- api: the REST endpoints (this module's blueprint, auth, search, bulk ingest, metrics)
+- admin: the Flask-Admin UI under /admin
+- migrate: Flask-Migrate, for `flask db ...`
+- all: everything, the default of `flask run` and the CLI
 
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
-
-# Setup the Flask-JWT-Extended extension
-app.config["JWT_SECRET_KEY"] = "super-secret"  # Change this!
-jwt = JWTManager(app)
+Several roles can be combined with commas; APP_ROLE sets the role when none is given.
+"""
+import os
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, url_for, stream_with_context
+from flask_cors import CORS
+from utils import APIException, generate_sitemap, paginate, insert_ignore, parse_fields, parse_ids, projection, apply_filters, parse_sort, _is_int
+from auth import setup_auth
+from cache import setup_cache, cached, conditional
+from compression import setup_compression
+from ingest import setup_ingest
+from metrics import setup_metrics
+from pool import engine_options
+from profiling import setup_profiling
+from ratelimit import setup_ratelimit
+from replicas import replica_binds, setup_replicas
+from json_provider import setup_json
+from search import setup_search
+from models import db, enforce_foreign_keys, User, Planets, Characters, Vehicles, Favourites
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import Integer, String, literal
+
+ROLES = ("api", "admin", "migrate")
+
+api = Blueprint("api", __name__)
+
+
+def parse_roles(role=None):
+    roles = {name.strip() for name in (role or os.getenv("APP_ROLE", "all")).split(",")}
+    if "all" in roles:
+        return set(ROLES)
+    unknown = roles - set(ROLES)
+    if unknown:
+        raise ValueError("unknown app role(s) %s, use %s or all" % (", ".join(sorted(unknown)), ", ".join(ROLES)))
+    return roles
+
+
+def create_app(role=None):
+    roles = parse_roles(role)
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False
+    setup_json(app)
+
+    db_url = os.getenv("DATABASE_URL")
+    if db_url is not None:
+        app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
+    else:
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['SQLALCHEMY_BINDS'] = replica_binds()
+
+    db.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            enforce_foreign_keys(engine)
+    # admin edits invalidate cached responses too, so every role gets the cache
+    setup_cache(app)
+    app.register_error_handler(APIException, handle_invalid_usage)
+
+    if "migrate" in roles:
+        # Alembic is only imported by the processes that run migrations
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    if "api" in roles:
+        CORS(app)
+        setup_ingest(app)
+        setup_metrics(app)
+        setup_ratelimit(app)
+        setup_replicas(app)
+        setup_profiling(app)
+        setup_search(app)
+        setup_auth(app)
+        app.register_blueprint(api)
+    if "admin" in roles:
+        # Flask-Admin, its templates and WTForms are the slowest imports of the app
+        from admin import setup_admin
+        setup_admin(app)
+    # last registered, so it runs first after a request: the other hooks see the
+    # compressed body (metrics record the size actually sent)
+    setup_compression(app)
+    return app
 
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
 def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
-# generate sitemap with all your endpoints
-@app.route('/')
-def sitemap():
-    return generate_sitemap(app)
+# Filters and sort columns of the list endpoints. Every one of them is backed by a
+# (column, id) B-tree index, see migration 2f7c4e9a1d63.
+LIST_FILTERS = {
+    Characters: {
+        "race": ("eq", "race", str),
+        "homeworld": ("eq", "homeworld", str),
+        "name_prefix": ("prefix", "name", str),
+    },
+    Planets: {
+        "min_population": ("ge", "population", int),
+        "max_population": ("le", "population", int),
+        "min_average_temp": ("ge", "averageTemp", int),
+        "max_average_temp": ("le", "averageTemp", int),
+    },
+    Vehicles: {
+        "min_length": ("ge", "length", int),
+        "max_length": ("le", "length", int),
+        "min_crew_size": ("ge", "crewSize", int),
+        "max_crew_size": ("le", "crewSize", int),
+    },
+}
+LIST_SORTS = {
+    Characters: ("name",),
+    Planets: ("name", "population", "averageTemp"),
+    Vehicles: ("name", "length", "crewSize"),
+}
+
+# Shared body of the list endpoints: one keyset page at a time instead of the whole table
+def list_response(model, empty_msg):
+    if "ids" in request.args:
+        return multi_get_response(model, empty_msg)
+    # select only the serialized columns (or the ?fields= asked for) as tuples, no ORM objects are built
+    fields = parse_fields(model)
+    sort_column, descending = parse_sort(model, LIST_SORTS.get(model, ()))
+    query, range_column = apply_filters(model.query, model, LIST_FILTERS.get(model, {}))
+    if sort_column is None and range_column is not None:
+        # range filtered pages come in the order of the filtered column, so the
+        # page is a single range scan of its (column, id) index
+        sort_column = range_column
+    keys = projection(fields)
+    if keys is not None and sort_column is not None:
+        # the next cursor is built from the sort column, so it has to be selected
+        sort_key = next(key for key, attr in model.serialized_fields.items() if attr == sort_column.key)
+        keys = keys + [sort_key] if sort_key not in keys else keys
+    query = query.with_entities(*model.serialized_columns(keys))
+    query_results, next_cursor = paginate(query, model, sort_column, descending)
+    results = [model.serialize_row(row, keys) for row in query_results]
+    if fields is not None:
+        for result in results:
+            for key in set(keys) - set(fields):
+                del result[key]
 
-# CHARACTERS CHARACTERS CHARACTERS CHARACTERS CHARACTERS CHARACTERS CHARACTERS
-# Endpoint to get all characters
-@app.route('/characters', methods=['GET'])
-def get_all_characters():
-    query_results = Characters.query.all()
-    results = list(map(lambda item: item.serialize(),query_results))
+    if results == []:
+        return jsonify({"msg": empty_msg}), 404
+    response_body = {
+        "msg": "All ok",
+        "results": results,
+        "next": next_cursor
+    }
+
+    return jsonify(response_body), 200
+
+# ?ids=1,5,9 on a list endpoint: those items with one IN (...) query, in the order
+# asked for, and the ids that don't exist under "missing"
+def multi_get_response(model, empty_msg):
+    combined = set(request.args) - {"ids", "fields"}
+    if combined:
+        raise APIException("ids can't be combined with %s" % ", ".join(sorted(combined)), status_code=400)
+    ids = parse_ids(request.args["ids"])
+    fields = parse_fields(model)
+    keys = projection(fields)
+    rows = model.query.with_entities(*model.serialized_columns(keys)).filter(model.id.in_(ids)).all()
+    found = {row.id: model.serialize_row(row, keys) for row in rows}
+    results = [found[item_id] for item_id in ids if item_id in found]
+    if fields is not None and "id" not in fields:
+        for result in results:
+            del result["id"]
+    missing = [item_id for item_id in ids if item_id not in found]
 
     if results == []:
-        return jsonify({"msg": "No characters found"}), 404
+        return jsonify({"msg": empty_msg, "missing": missing}), 404
     response_body = {
         "msg": "All ok",
-        "results": results
+        "results": results,
+        "missing": missing
     }
 
     return jsonify(response_body), 200
 
+# Shared lookup of the single item endpoints, honouring ?fields=. Returns the serialized item or None
+def find_one(model, item_id):
+    fields = parse_fields(model)
+    row = model.query.with_entities(*model.serialized_columns(fields)).filter(model.id == item_id).first()
+    return None if row is None else model.serialize_row(row, fields)
+
+# Resources that can be dumped in full through /export/<resource>
+EXPORT_RESOURCES = {
+    "characters": Characters,
+    "planets": Planets,
+    "vehicles": Vehicles,
+}
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 1000))
+
+# Kinds of favourites: kind (Favourites.kind, and the URL segment) -> (target model, label)
+FAVOURITE_KINDS = {
+    "characters": (Characters, "character"),
+    "planets": (Planets, "planet"),
+    "vehicles": (Vehicles, "vehicle"),
+}
+
+def favourite_insert(session, user_id, kind, target_id):
+    """INSERT ... SELECT of one favourite that inserts nothing when the target does
+    not exist or the user already has it"""
+    model = FAVOURITE_KINDS[kind][0]
+    target = db.select(literal(user_id, Integer), literal(kind, String), model.id).where(model.id == target_id)
+    return insert_ignore(Favourites.__table__, session).from_select(["user_id", "kind", "target_id"], target)
+
+# Shared body of the "add to favourites" endpoint. The common path is a single
+# INSERT ... SELECT ... ON CONFLICT DO NOTHING: the target is read by primary key in
+# the same statement, the unique index catches duplicates and the foreign key
+# catches missing users, so nothing is looked up beforehand.
+def add_favourite(user_id, kind, target_id):
+    model, label = FAVOURITE_KINDS[kind]
+    try:
+        result = db.session.execute(favourite_insert(db.session, user_id, kind, target_id))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        if db.session.get(User, user_id) is not None:
+            raise
+        result = None
+
+    if result is not None and result.rowcount == 1:
+        return jsonify({"msg": "ok"}), 200
+    # slow path, nothing was inserted: find out why
+    user_exists = db.session.get(User, user_id) is not None
+    target_exists = db.session.get(model, target_id) is not None
+    if not user_exists and not target_exists:
+        return jsonify({"msg": "both user and %s do not exist" % label}), 400
+    if not user_exists:
+        return jsonify({"msg": "this user does not exist"}), 400
+    if not target_exists:
+        return jsonify({"msg": "this %s does not exist" % label}), 400
+    return jsonify({"msg": "this user already has this %s as a favorite" % label}), 200
+
+def body_user_id(body):
+    """The user_id of a favourites request body, a JSON object"""
+    if body is not None and not isinstance(body, dict):
+        raise APIException("The body must be a JSON object", status_code=400)
+    user_id = (body or {}).get("user_id")
+    if not _is_int(user_id):
+        raise APIException("user_id must be an integer", status_code=400)
+    return user_id
+
+def favourite_user_id():
+    return body_user_id(request.get_json(silent=True))
+
+MAX_FAVOURITES_BATCH = 500
+
+# generate sitemap with all your endpoints
+@api.route('/')
+def sitemap():
+    return generate_sitemap(current_app)
+
+# EXPORT EXPORT EXPORT EXPORT EXPORT EXPORT EXPORT EXPORT EXPORT EXPORT EXPORT EXPORT
+# Endpoint to stream a whole table, reading the DB in chunks so memory stays flat.
+# ?format=ndjson (default) sends one object per line, ?format=json a JSON array.
+@api.route('/export/<resource>', methods=['GET'])
+def export_resource(resource):
+    model = EXPORT_RESOURCES.get(resource)
+    if model is None:
+        return jsonify({"msg": "No resource with that name"}), 404
+    output_format = request.args.get("format", "ndjson")
+    if output_format not in ("ndjson", "json"):
+        return jsonify({"msg": "format must be ndjson or json"}), 400
+
+    fields = parse_fields(model)
+    dumps = current_app.json.dumps
+
+    def generate():
+        statement = (db.select(*model.serialized_columns(fields)).order_by(model.id)
+                     .execution_options(yield_per=EXPORT_CHUNK_SIZE))
+        rows = db.session.execute(statement)
+        if output_format == "ndjson":
+            for row in rows:
+                yield dumps(model.serialize_row(row, fields)) + "\n"
+            return
+        separator = "["
+        for row in rows:
+            yield separator + dumps(model.serialize_row(row, fields))
+            separator = ","
+        yield "[]" if separator == "[" else "]"
+
+    mimetype = "application/x-ndjson" if output_format == "ndjson" else "application/json"
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+# CHARACTERS CHARACTERS CHARACTERS CHARACTERS CHARACTERS CHARACTERS CHARACTERS
+# Endpoint to get all characters
+@api.route('/characters', methods=['GET'])
+@conditional("characters")
+@cached("characters")
+def get_all_characters():
+    return list_response(Characters, "No characters found")
+
 # Endpoint to get individual characters
-@app.route('/characters/<int:characters_id>', methods=['GET'])
+@api.route('/characters/<int:characters_id>', methods=['GET'])
+@conditional("characters")
+@cached("characters")
 def get_one_character(characters_id):
-    query_result = Characters.query.filter_by(id=characters_id).first()
+    query_result = find_one(Characters, characters_id)
     if query_result is None:
         return jsonify({"msg":"No character with that ID exists"}), 404
     response_body = {
         "msg": "All working",
-        "query result": query_result.serialize()
+        "query result": query_result
     }
 
     return jsonify(response_body), 200
 
 # Endpoint for POST for characters
-@app.route('/characters', methods=['POST'])
+@api.route('/characters', methods=['POST'])
 def create_character():
     # query_result = Characters.query.filter_by(id=characters_id).first()
     data = request.json
@@ -87,107 +331,32 @@ def create_character():
 
     return jsonify(response_body), 200
 
-# Endpoint for Add a new favourite character to the current user with the character id = character_id.
-# @app.route('/favourites/characters/<int:characters_id>', methods=['POST'])
-# def create_character_in_favourites(characters_id):
-#     # query_result = Characters.query.filter_by(id=characters_id).first()
-#     data = request.json
-#     print(data)
-#     new_character = Characters(name=data["name"], race=data["race"], homeworld=data["homeworld"])
-#     print(new_character)
-#     db.session.add(new_character)
-#     db.session.commit()
-#     response_body = {
-#         "msg": "Character successfully added to favourites",
-#         # "query result": query_result
-#     }
-
-#     return jsonify(response_body), 200
-
-@app.route('/favourites/characters/<int:characters_id>', methods=['POST'])
-def create_character_in_favourites(characters_id):
-    data = request.json
-    print(data)
-    print(characters_id)
-    user_exists = User.query.filter_by(id=data["user_id"]).first()
-    characters_exists = Characters.query.filter_by(id=characters_id).first()
-    
-    if user_exists and characters_exists: 
-
-
-        query_results = Favourites.query.filter_by(favouriteCharacters_id=characters_id, user_id=data["user_id"]).first()
-
-        if query_results is None: 
-
-            new_favorite = Favourites(favouriteCharacters_id=characters_id, user_id=data["user_id"])
-            db.session.add(new_favorite)
-            db.session.commit()
-            return ({"msg": "ok"}), 200     
-
-        else:
-            return ({"msg": "this user already has this character as a favorite"}), 200
-        
-    elif user_exists is None and characters_exists is None:
-        return ({"msg": "both user and character do not exist"}), 400
-    
-    elif user_exists is None: 
-        return ({"msg": "this user does not exist"}), 400
-    
-    elif characters_exists is None: 
-        return ({"msg": "this character does not exist"}), 400 
-    
-# Endpoint for deleting a favourite character of the current user
-@app.route('/favourites/characters/<int:characters_id>', methods=['DELETE'])
-def delete_one_favourite_character(characters_id):
-    data = request.json
-    
-    user_id = data["user_id"]
-    character_to_delete = Favourites.query.filter_by(favouriteCharacters_id=characters_id, user_id=user_id).first()
-    print(character_to_delete)
-
-    if character_to_delete:
-        db.session.delete(character_to_delete)
-        db.session.commit()
-        print(f"User with ID {user_id} deleted successfully.")
-
-        response_body = {
-        "msg": "Successfully deleted from favourites"
-        }
-        return jsonify(response_body), 200
-    else:
-        return(f"User with ID {user_id} not found."), 404
 
 # PLANETS PLANETS PLANETS PLANETS PLANETS PLANETS PLANETS PLANETS PLANETS PLANETS PLANETS
 # Endpoint to get all planets
-@app.route('/planets', methods=['GET'])
+@api.route('/planets', methods=['GET'])
+@conditional("planets")
+@cached("planets")
 def get_all_planets():
-    query_results = Planets.query.all()
-    results = list(map(lambda item: item.serialize(),query_results))
-
-    if results == []:
-        return jsonify({"msg": "No planets found"}), 404
-    response_body = {
-        "msg": "All ok",
-        "results": results
-    }
-
-    return jsonify(response_body), 200
+    return list_response(Planets, "No planets found")
 
 # Endpoint to get individual planets
-@app.route('/planets/<int:planets_id>', methods=['GET'])
+@api.route('/planets/<int:planets_id>', methods=['GET'])
+@conditional("planets")
+@cached("planets")
 def get_one_planet(planets_id):
-    query_result = Planets.query.filter_by(id=planets_id).first()
+    query_result = find_one(Planets, planets_id)
     if query_result is None:
         return jsonify({"msg": "no planet with that ID"}), 404
     response_body = {
         "msg": "ok",
-        "result":query_result.serialize()
+        "result":query_result
     }
 
     return jsonify(response_body), 200
 
 # Endpoint to add a new planet to planet list with the planet id = planet_id.
-@app.route('/planets', methods=['POST'])
+@api.route('/planets', methods=['POST'])
 def create_planet():
     # query_result = Characters.query.filter_by(id=characters_id).first()
     data = request.json
@@ -203,179 +372,56 @@ def create_planet():
 
     return jsonify(response_body), 200
 
-# Endpoint for adding a new favourite planet to the current user
-@app.route('/favourites/planets/<int:planets_id>', methods=['POST'])
-def create_planet_in_favourites(planets_id):
-    data = request.json
-    print(data)
-    print(planets_id)
-    user_exists = User.query.filter_by(id=data["user_id"]).first()
-    planets_exists = Planets.query.filter_by(id=planets_id).first()
-    
-    if user_exists and planets_exists: 
-
-
-        query_results = Favourites.query.filter_by(favouritePlanets_id=planets_id, user_id=data["user_id"]).first()
-
-        if query_results is None: 
-
-            new_favorite = Favourites(favouritePlanets_id=planets_id, user_id=data["user_id"])
-            db.session.add(new_favorite)
-            db.session.commit()
-            return ({"msg": "ok"}), 200
-
-       
-
-        else:
-            return ({"msg": "this user already has this planet as a favorite"}), 200
-        
-    elif user_exists is None and planets_exists is None:
-        return ({"msg": "both user and planet do not exist"}), 400
-    
-    elif user_exists is None: 
-        return ({"msg": "this user does not exist"}), 400
-    
-    elif planets_exists is None: 
-        return ({"msg": "this planet does not exist"}), 400 
-
-# Endpoint for deleting a favourite planet of the current user
-@app.route('/favourites/planets/<int:planets_id>', methods=['DELETE'])
-def delete_one_favourite_planet(planets_id):
-    data = request.json
-    
-    user_id = data["user_id"]
-    planet_to_delete = Favourites.query.filter_by(favouritePlanets_id=planets_id, user_id=user_id).first()
-    print(planet_to_delete)
-
-    if planet_to_delete:
-        db.session.delete(planet_to_delete)
-        db.session.commit()
-        print(f"User with ID {user_id} deleted successfully.")
-
-        response_body = {
-        "msg": "Successfully deleted from favourites"
-        }
-        return jsonify(response_body), 200
-    else:
-        return(f"User with ID {user_id} not found."), 404
 
 
 # VEHICLES VEHICLES VEHICLES VEHICLES VEHICLES VEHICLES VEHICLES VEHICLES VEHICLES VEHICLES
 # Endpoint to get all vehicles
-@app.route('/vehicles', methods=['GET'])
+@api.route('/vehicles', methods=['GET'])
+@conditional("vehicles")
+@cached("vehicles")
 def get_all_vehicles():
-    query_results = Vehicles.query.all()
-    results = list(map(lambda item: item.serialize(),query_results))
-   
-    if results == []:
-        return jsonify({"msg": "No vehicles found"}), 404
-    response_body = {
-        "msg": "All ok",
-        "results": results
-    }
-
-    return jsonify(response_body), 200
+    return list_response(Vehicles, "No vehicles found")
 
 # Endpoint to get a specific vehicle
-@app.route('/vehicles/<int:vehicles_id>', methods=['GET'])
+@api.route('/vehicles/<int:vehicles_id>', methods=['GET'])
+@conditional("vehicles")
+@cached("vehicles")
 def get_one_vehicle(vehicles_id):
-    query_result = Vehicles.query.filter_by(id=vehicles_id).first()
-    print(query_result.serialize())
+    query_result = find_one(Vehicles, vehicles_id)
+    if query_result is None:
+        return jsonify({"msg": "no vehicle with that ID"}), 404
     response_body = {
         "msg": "All working",
-        "query result": query_result.serialize()
+        "query result": query_result
     }
 
     return jsonify(response_body), 200
 
-# Endpoint for Add a new favourite vehicle to the current user with the vehicles id = vehicles_id.
-@app.route('/favourites/vehicles/<int:vehicles_id>', methods=['POST'])
-def create_vehicle_in_favourites(vehicles_id):
-    data = request.json
-    print(data)
-    print(vehicles_id)
-    user_exists = User.query.filter_by(id=data["user_id"]).first()
-    vehicles_exists = Vehicles.query.filter_by(id=vehicles_id).first()
-    
-    if user_exists and vehicles_exists: 
-
-
-        query_results = Favourites.query.filter_by(favouritePlanets_id=vehicles_id, user_id=data["user_id"]).first()
-
-        if query_results is None: 
-
-            new_favorite = Favourites(favouritePlanets_id=vehicles_id, user_id=data["user_id"])
-            db.session.add(new_favorite)
-            db.session.commit()
-            return ({"msg": "ok"}), 200
-
-       
-
-        else:
-            return ({"msg": "this user already has this vehicles as a favorite"}), 200
-        
-    elif user_exists is None and vehicles_exists is None:
-        return ({"msg": "both user and vehicles do not exist"}), 400
-    
-    elif user_exists is None: 
-        return ({"msg": "this user does not exist"}), 400
-    
-    elif vehicles_exists is None: 
-        return ({"msg": "this vehicles does not exist"}), 400
-    
-# Endpoint for deleting a favourite vehicle of the current user
-@app.route('/favourites/vehicles/<int:vehicles_id>', methods=['DELETE'])
-def delete_one_favourite_vehicle(vehicles_id):
-    data = request.json
-    
-    user_id = data["user_id"]
-    vehicle_to_delete = Favourites.query.filter_by(favouriteVehicles_id=vehicles_id, user_id=user_id).first()
-    print(vehicle_to_delete)
-
-    if vehicle_to_delete:
-        db.session.delete(vehicle_to_delete)
-        db.session.commit()
-        print(f"User with ID {user_id} deleted successfully.")
-
-        response_body = {
-        "msg": "Successfully deleted from favourites"
-        }
-        return jsonify(response_body), 200
-    else:
-        return(f"User with ID {user_id} not found."), 404
 
 # USERS USERS USERS USERS USERS USERS USERS USERS USERS USERS USERS USERS USERS
 # Endpoint to get all users
-@app.route('/user', methods=['GET'])
+@api.route('/user', methods=['GET'])
+@conditional("user", public=False)
 def get_all_users():
-    query_results = User.query.all()
-    results = list(map(lambda item: item.serialize(),query_results))
-
-    if results == []:
-        return jsonify({"msg": "No users found"}), 404
-    response_body = {
-        "msg": "All ok",
-        "results": results
-    }
-
-    return jsonify(response_body), 200
+    return list_response(User, "No users found")
 
 
 # Endpoint to get specific user
-@app.route('/user/<int:user_id>', methods=['GET'])
+@api.route('/user/<int:user_id>', methods=['GET'])
+@conditional("user", public=False)
 def get_one_user(user_id):
-    query_result = User.query.filter_by(id=user_id).first()
+    query_result = find_one(User, user_id)
     if query_result is None:
         return jsonify({"msg": "no user with ID provided"}), 404
     response_body = {
         "msg": "It's working, all ok",
-        "query result": query_result.serialize()
+        "query result": query_result
     }
 
     return jsonify(response_body), 200
 
 # Endpoint for POST for users
-@app.route('/users', methods=['POST'])
+@api.route('/users', methods=['POST'])
 def create_user():
     # query_result = Characters.query.filter_by(id=characters_id).first()
     data = request.json
@@ -392,9 +438,9 @@ def create_user():
 
 # FAVOURITES FAVOURITES FAVOURITES FAVOURITES FAVOURITES FAVOURITES FAVOURITES FAVOURITES FAVOURITES
 # Endpoint to get all favourites of a user
-@app.route('/users/favourites', methods=['GET'])
+@api.route('/users/favourites', methods=['GET'])
 def get_all_user_favourites():
-    query_results = Favourites.query.all()
+    query_results = Favourites.query.options(*Favourites.eager_targets()).all()
     results = list(map(lambda item: item.serialize(),query_results))
 
     if results == []:
@@ -406,98 +452,103 @@ def get_all_user_favourites():
 
     return jsonify(response_body), 200
 
-@app.route('/users/favourites/<int:user_id>', methods=['GET'])
+@api.route('/users/favourites/<int:user_id>', methods=['GET'])
+@conditional("favourites", "characters", "planets", "vehicles", public=False)
 def get_all_favourites(user_id):
-    query_results = Favourites.query.filter_by(user_id=user_id).first()
-    print(query_results)
-    
-    if query_results is None:
+    # one round-trip: the user's rows come from the (user_id, id) index and the
+    # planet, character and vehicle are joined into the same SELECT
+    query_results = (Favourites.query.options(*Favourites.eager_targets())
+                     .filter_by(user_id=user_id).order_by(Favourites.id).all())
+
+    if query_results == []:
         return jsonify({"msg": "No matching user with that ID"}), 404
     response_body = {
         "msg": "All ok",
-        "results": query_results.serialize()
+        "results": list(map(lambda item: item.serialize(), query_results))
     }
 
     return jsonify(response_body), 200
 
-# JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT
-# Create a route to authenticate your users and return JWTs. The
-# create_access_token() function is used to actually generate the JWT.
-@app.route("/signup", methods=["POST"])
-def signup():
+# Endpoint to add a character, planet or vehicle to the favourites of a user
+# Body: {"user_id": 1}
+@api.route('/favourites/<any(characters, planets, vehicles):kind>/<int:target_id>', methods=['POST'])
+def create_favourite(kind, target_id):
+    return add_favourite(favourite_user_id(), kind, target_id)
+
+# Endpoint to remove a character, planet or vehicle from the favourites of a user,
+# a single DELETE on the (user_id, kind, target_id) index
+@api.route('/favourites/<any(characters, planets, vehicles):kind>/<int:target_id>', methods=['DELETE'])
+def delete_favourite(kind, target_id):
+    user_id = favourite_user_id()
+    result = db.session.execute(db.delete(Favourites).where(
+        Favourites.user_id == user_id, Favourites.kind == kind, Favourites.target_id == target_id))
+    db.session.commit()
+    if result.rowcount == 0:
+        return(f"User with ID {user_id} not found."), 404
+    return jsonify({"msg": "Successfully deleted from favourites"}), 200
+
+# Endpoint to add and remove many favourites of a user in one transaction.
+# Body: {"user_id": 1, "add": [{"kind": "planets", "id": 3}], "remove": [{"kind": "vehicles", "id": 2}]}
+@api.route('/favourites/batch', methods=['POST'])
+def batch_favourites():
     data = request.json
-    new_signup = User(userName=data.get("userName"), email=data.get("email"), password=data.get("password"))
-    db.session.add(new_signup)
+    user_id = body_user_id(data)
+    if not all(isinstance(data.get(action, []), list) for action in ("add", "remove")):
+        raise APIException("add and remove must be lists", status_code=400)
+    items = [("add", item) for item in data.get("add", [])] + [("remove", item) for item in data.get("remove", [])]
+    if len(items) > MAX_FAVOURITES_BATCH:
+        raise APIException("A batch can hold at most %d items" % MAX_FAVOURITES_BATCH, status_code=400)
+    for action, item in items:
+        if not isinstance(item, dict) or item.get("kind") not in FAVOURITE_KINDS or not _is_int(item.get("id")):
+            raise APIException("Every item needs a kind (characters, planets or vehicles) and an integer id", status_code=400)
+    if db.session.get(User, user_id) is None:
+        return jsonify({"msg": "this user does not exist"}), 404
+
+    # set-based lookups: one IN (...) query per kind for the targets, one on the
+    # (user_id, kind, target_id) index for the user's favourites
+    existing_targets = {}
+    for kind, (model, label) in FAVOURITE_KINDS.items():
+        ids = {item["id"] for action, item in items if item["kind"] == kind}
+        if ids:
+            existing_targets[kind] = set(db.session.scalars(db.select(model.id).where(model.id.in_(ids))))
+    existing_favourites = set(db.session.execute(
+        db.select(Favourites.kind, Favourites.target_id).where(
+            Favourites.user_id == user_id, Favourites.kind.in_(list(existing_targets)),
+            Favourites.target_id.in_({item["id"] for action, item in items}))).tuples())
+
+    results = []
+    to_insert = []
+    to_delete = {}
+    for action, item in items:
+        kind, target_id = item["kind"], item["id"]
+        if target_id not in existing_targets[kind]:
+            status = "not_found"
+        elif action == "add":
+            if (kind, target_id) in existing_favourites:
+                status = "already_favourite"
+            else:
+                to_insert.append({"user_id": user_id, "kind": kind, "target_id": target_id})
+                existing_favourites.add((kind, target_id))
+                status = "added"
+        else:
+            if (kind, target_id) in existing_favourites:
+                to_delete.setdefault(kind, set()).add(target_id)
+                existing_favourites.discard((kind, target_id))
+                status = "removed"
+            else:
+                status = "not_favourite"
+        results.append({"action": action, "kind": kind, "id": target_id, "status": status})
+
+    if to_insert:
+        db.session.execute(insert_ignore(Favourites.__table__, db.session), to_insert)
+    for kind, ids in to_delete.items():
+        db.session.execute(db.delete(Favourites).where(
+            Favourites.user_id == user_id, Favourites.kind == kind, Favourites.target_id.in_(ids)))
     db.session.commit()
-    return jsonify({"msg": "User signed up successfully"}), 200
 
+    return jsonify({"msg": "ok", "results": results}), 200
 
-# Create a route to authenticate your users and return JWTs. The
-# create_access_token() function is used to actually generate the JWT.
-@app.route("/login", methods=["POST"])
-def login():
-    data = request.json
-    userName = data.get("userName", None)
-    password = data.get("password", None)
-    
-    username_result = User.query.filter_by(userName=userName).first()
-    
-    print(userName)
-    print(password)
-    print(username_result.userName)
-    print(username_result.password)
-    # if userName is None or password is None:
-    #     return jsonify({"msg": "Bad username or password"}), 404
-    if userName != username_result.userName or password != username_result.password:
-        return jsonify({"msg": "Bad username or password"}), 401
-
-    # return jsonify({"msg": "User logged in successfully"}), 200
-    access_token = create_access_token(identity=userName)
-    return jsonify(access_token=access_token), 200
-
-
-# Protect a route with jwt_required, which will kick out requests
-# without a valid JWT present.
-@app.route("/private", methods=["GET"])
-@jwt_required()
-def protected():
-    # Access the identity of the current user with get_jwt_identity
-    current_user = get_jwt_identity()
-    return jsonify(logged_in_as=current_user), 200
-
-# validToken: function () {
-# 				fetch(`https://humble-space-orbit-4jjwqw7xr9w4f7j6w-3000.app.github.dev/valid-token`, {
-# 					method: 'GET',
-# 					headers: {
-# 						'Content-Type': 'application/json',
-# 						'Authorization': 'Bearer ' + localStorage.getItem("access_token")
-# 					}
-# 				})
-# 					.then(res => {
-# 						res.json()
-# 						if (res.status == 200) { setStore({ validacion: true }) };
-# 					})
-# 					.then(data => {
-# 						console.log(data);
-# 					})
-# 					.catch(err => console.error(err))
-# 			}
-
-@app.route("/valid-token", methods=["GET"])
-@jwt_required()
-def valid_token():
-    # Access the identity of the current user with get_jwt_identity
-    current_user = get_jwt_identity()
-    consulta = User.query.filter_by(email=current_user).first()
-
-
-    if consulta is None :
-        return jsonify({"msg":"el usuario no existe", "estado":False}, 404)
-    
-
-    return jsonify({"estado":True}), 200
-
-# @app.route('/characters', methods=['GET'])
+# @api.route('/characters', methods=['GET'])
 # def handle_hello():
 
 #     response_body = {
@@ -509,4 +560,4 @@ def valid_token():
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
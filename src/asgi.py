@@ -0,0 +1,338 @@
+"""
+ASGI entry point: `uvicorn asgi:app --app-dir src` (or gunicorn with uvicorn workers).
+
+The catalogue and favourites handlers below run on an async SQLAlchemy engine
+(asyncpg / aiosqlite), so a request waiting on the database does not hold a
+worker. Around them runs what the Flask app runs around the same views: the
+rate limit and admission control of ratelimit.py, the ETag/304 and response cache
+policy the views declare with @conditional and @cached (read off the Flask view
+of the route, entries are shared with it), compression, the CORS headers of
+CORS(app) and the request metrics. Not run: the SQL profiling of profiling.py
+and the read replica routing of replicas.py, these handlers query the primary.
+Every other route falls through to the regular Flask app, which keeps working
+unchanged behind wsgi.py (including the lazily created admin UI).
+"""
+import asyncio
+import json
+import math
+import os
+import re
+import time
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from flask_cors.core import get_cors_headers, get_cors_options
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_etags, quote_etag
+from wsgi import app as flask_app, application
+from app import FAVOURITE_KINDS, body_user_id, favourite_insert
+from cache import CACHE_REQUESTS, body_etag, cache_control, cache_lookup, cache_store, compressed_copy, response_cache
+from compression import compression
+from metrics import HTTP_FINISHED, HTTP_REQUEST_SECONDS, HTTP_REQUESTS, HTTP_RESPONSE_BYTES, HTTP_STARTED, start_flusher
+from models import enforce_foreign_keys, User, Planets, Characters, Vehicles, Favourites
+from pool import engine_options
+from ratelimit import ADMISSION_SHED, admission, client_identity, rate_limiter
+from utils import APIException, decode_cursor, encode_cursor, parse_page_size, parse_fields_value, projection
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+    "mysql": "mysql+aiomysql",
+}
+
+
+def async_database_url(url):
+    scheme, rest = url.split("://", 1)
+    return "%s://%s" % (ASYNC_DRIVERS.get(scheme.split("+")[0], scheme), rest)
+
+
+def async_engine_options(url):
+    options = dict(engine_options(url))
+    # async engines need their own adapted pool class
+    options.pop("poolclass", None)
+    return options
+
+
+database_url = flask_app.config["SQLALCHEMY_DATABASE_URI"]
+engine = create_async_engine(async_database_url(database_url), **async_engine_options(database_url))
+enforce_foreign_keys(engine.sync_engine)
+Session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+# resource -> (model, 404 message of the list, 404 message of one item, message and key of one item)
+CATALOGUE = {
+    "characters": (Characters, "No characters found", "No character with that ID exists", "All working", "query result"),
+    "planets": (Planets, "No planets found", "no planet with that ID", "ok", "result"),
+    "vehicles": (Vehicles, "No vehicles found", "no vehicle with that ID", "All working", "query result"),
+}
+ASYNC_LIST_PARAMS = {"limit", "cursor", "fields"}
+
+
+async def list_resource(session, query, body, resource):
+    model, empty_msg = CATALOGUE[resource][:2]
+    limit = parse_page_size(query.get("limit"))
+    fields = parse_fields_value(model, query.get("fields"))
+    keys = projection(fields)
+    statement = select(*model.serialized_columns(keys)).order_by(model.id).limit(limit + 1)
+    if query.get("cursor"):
+        statement = statement.where(model.id > decode_cursor(query["cursor"]))
+    rows = (await session.execute(statement)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].id)
+    if rows == []:
+        return 404, {"msg": empty_msg}
+    results = [model.serialize_row(row, keys) for row in rows]
+    if fields is not None and "id" not in fields:
+        for result in results:
+            del result["id"]
+    return 200, {"msg": "All ok", "results": results, "next": next_cursor}
+
+
+async def get_resource(session, query, body, resource, item_id):
+    model, _, missing_msg, ok_msg, key = CATALOGUE[resource]
+    fields = parse_fields_value(model, query.get("fields"))
+    statement = select(*model.serialized_columns(fields)).where(model.id == int(item_id))
+    row = (await session.execute(statement)).first()
+    if row is None:
+        return 404, {"msg": missing_msg}
+    return 200, {"msg": ok_msg, key: model.serialize_row(row, fields)}
+
+
+async def list_favourites(session, query, body, user_id):
+    statement = (select(Favourites).options(*Favourites.eager_targets())
+                 .where(Favourites.user_id == int(user_id)).order_by(Favourites.id))
+    rows = list(await session.scalars(statement))
+    if rows == []:
+        return 404, {"msg": "No matching user with that ID"}
+    return 200, {"msg": "All ok", "results": [row.serialize() for row in rows]}
+
+
+async def add_favourite(session, query, body, kind, target_id):
+    model, label = FAVOURITE_KINDS[kind]
+    user_id = body_user_id(body)
+    target_id = int(target_id)
+    try:
+        result = await session.execute(favourite_insert(session, user_id, kind, target_id))
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        if await session.get(User, user_id) is not None:
+            raise
+        result = None
+    if result is not None and result.rowcount == 1:
+        return 200, {"msg": "ok"}
+    user_exists = await session.get(User, user_id) is not None
+    target_exists = await session.get(model, target_id) is not None
+    if not user_exists and not target_exists:
+        return 400, {"msg": "both user and %s do not exist" % label}
+    if not user_exists:
+        return 400, {"msg": "this user does not exist"}
+    if not target_exists:
+        return 400, {"msg": "this %s does not exist" % label}
+    return 200, {"msg": "this user already has this %s as a favorite" % label}
+
+ROUTES = [
+    ("GET", re.compile(r"^/(characters|planets|vehicles)$"), list_resource),
+    ("GET", re.compile(r"^/(characters|planets|vehicles)/(\d+)$"), get_resource),
+    ("GET", re.compile(r"^/users/favourites/(\d+)$"), list_favourites),
+    ("POST", re.compile(r"^/favourites/(characters|planets|vehicles)/(\d+)$"), add_favourite),
+]
+
+
+def match_route(method, path):
+    path = path.rstrip("/") or "/"
+    for route_method, pattern, handler in ROUTES:
+        if method == route_method:
+            match = pattern.match(path)
+            if match:
+                return handler, match.groups()
+    return None, None
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    raw = b"".join(chunks)
+    return json.loads(raw) if raw else None
+
+
+def json_body(payload):
+    # the bytes jsonify() produces, so cache entries are shared with the Flask views
+    return flask_app.json.response(payload).get_data()
+
+
+def remote_address(scope, headers):
+    forwarded = headers.get(b"x-forwarded-for")
+    if os.getenv("RATELIMIT_TRUST_PROXY", "0") == "1" and forwarded:
+        return forwarded.decode("latin-1").split(",")[0].strip()
+    return (scope.get("client") or ("unknown",))[0]
+
+
+async def admit():
+    """None once the request holds an admission slot, otherwise why it was shed.
+    Waiting for a slot blocks, so it happens on an executor thread"""
+    if admission.try_acquire():
+        return None
+    waiting = asyncio.get_running_loop().run_in_executor(None, admission.acquire)
+    try:
+        return await asyncio.shield(waiting)
+    except asyncio.CancelledError:
+        # the client went away: give the slot back if it was granted after all
+        waiting.add_done_callback(lambda future: future.result() is None and admission.release())
+        raise
+
+
+async def run_handler(scope, receive, handler, arguments, query):
+    try:
+        body = await read_body(receive) if scope["method"] == "POST" else None
+        async with Session() as session:
+            status, payload = await handler(session, query, body, *arguments)
+    except APIException as error:
+        status, payload = error.status_code, error.to_dict()
+    except ValueError:
+        status, payload = 400, {"message": "Invalid JSON body"}
+    return status, json_body(payload)
+
+
+async def respond(scope, receive, endpoint, handler, arguments, query):
+    """(status, body, headers) of an async route, with what the Flask app runs
+    around the same view: rate limit, admission control, the ETag/304 of
+    @conditional, the response cache of @cached and response compression"""
+    headers = dict(scope["headers"])
+    if rate_limiter.enabled:
+        with flask_app.app_context():
+            client = client_identity(headers.get(b"authorization", b"").decode("latin-1"),
+                                     remote_address(scope, headers))
+        allowed, retry_after = rate_limiter.hit(endpoint, client)
+        if not allowed:
+            return 429, json_body({"msg": "Too many requests, slow down"}), [
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode())]
+    if admission.enabled:
+        shed_reason = await admit()
+        if shed_reason is not None:
+            ADMISSION_SHED.inc(reason=shed_reason)
+            return 503, json_body({"msg": "Server busy, try again later"}), [(b"retry-after", b"1")]
+    try:
+        return await respond_admitted(scope, receive, headers, endpoint, handler, arguments, query)
+    finally:
+        if admission.enabled:
+            admission.release()
+
+
+def validators(etag, public, weak=False):
+    return [(b"etag", quote_etag(etag, weak).encode()), (b"cache-control", cache_control(public).encode())]
+
+
+async def respond_admitted(scope, receive, headers, endpoint, handler, arguments, query):
+    view = flask_app.view_functions[endpoint]
+    path, query_string = scope["path"], scope["query_string"]
+    encoding = compression.negotiate_header(headers.get(b"accept-encoding", b"").decode("latin-1"))
+    response_headers = [(b"vary", b"Accept-Encoding")] if compression.enabled else []
+
+    etag_tables = getattr(view, "etag_tables", None)
+    if_none_match = parse_etags(headers.get(b"if-none-match", b"").decode("latin-1"))
+    etag = response_cache.etag_for(etag_tables, path, query_string) if etag_tables is not None else None
+    if etag is not None and if_none_match.contains_weak(etag):
+        return 304, b"", validators(etag, view.etag_public) + response_headers
+
+    cached_tables = getattr(view, "cached_tables", None)
+    if cached_tables is not None and response_cache.enabled:
+        key = response_cache.key_for(cached_tables, path, query_string)
+        entry, body_encoding = cache_lookup(key, encoding)
+        if entry is not None:
+            CACHE_REQUESTS.inc(endpoint=endpoint, outcome="hit")
+            response_headers.append((b"x-cache", b"HIT"))
+            body, status = entry[:2]
+            if body_encoding is None:
+                body, body_encoding = compressed_copy(key, entry, encoding)
+        else:
+            CACHE_REQUESTS.inc(endpoint=endpoint, outcome="miss")
+            response_headers.append((b"x-cache", b"MISS"))
+            status, body = await run_handler(scope, receive, handler, arguments, query)
+            if status in (200, 404):
+                body, body_encoding = cache_store(key, (body, status, "application/json"), encoding)
+    else:
+        status, body = await run_handler(scope, receive, handler, arguments, query)
+        body_encoding = None
+    if etag_tables is not None and status == 200 and etag is None:
+        # the body as @conditional sees it in the Flask view
+        etag = body_etag(body)
+        if if_none_match.contains_weak(etag):
+            return 304, b"", validators(etag, view.etag_public) + response_headers
+    if body_encoding is None and encoding is not None and compression.worth_it("application/json", len(body)):
+        body, body_encoding = compression.compress(body, encoding), encoding
+
+    if body_encoding is not None:
+        response_headers.append((b"content-encoding", body_encoding.encode()))
+    if etag_tables is not None and status == 200:
+        # a compressed body carries the weak form of the tag, as in compression.py
+        response_headers += validators(etag, view.etag_public, weak=body_encoding is not None)
+    return status, body, response_headers
+
+
+async def serve(scope, receive, send, handler, arguments, query):
+    method = scope["method"]
+    endpoint = url_adapter.match(scope["path"].rstrip("/") or "/", method)[0]
+    start_flusher()
+    HTTP_STARTED.inc()
+    started = time.perf_counter()
+    try:
+        status, body, headers = await respond(scope, receive, endpoint, handler, arguments, query)
+        headers += cors_headers(scope, method)
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=method, status=status)
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, method=method)
+        HTTP_RESPONSE_BYTES.observe(len(body), endpoint=endpoint)
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                        *headers],
+        })
+        await send({"type": "http.response.body", "body": body})
+    finally:
+        HTTP_FINISHED.inc()
+
+
+def cors_headers(scope, method):
+    """What CORS(app) adds to the responses of the Flask app (every route, the
+    app's CORS_* settings)"""
+    request_headers = Headers([(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope["headers"]])
+    return [(name.lower().encode("latin-1"), str(value).encode("latin-1"))
+            for name, value in get_cors_headers(cors_options, request_headers, method).items(multi=True)]
+
+
+wsgi_app = WsgiToAsgi(application)
+cors_options = get_cors_options(flask_app)
+url_adapter = flask_app.url_map.bind("localhost")
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    handler, arguments, query = (None, None, {})
+    if scope["type"] == "http":
+        handler, arguments = match_route(scope["method"], scope["path"])
+        # the first value of a repeated parameter, as request.args.get() in the Flask views
+        query = {key: values[0] for key, values in parse_qs(scope["query_string"].decode("utf-8", "replace")).items()}
+    if handler is list_resource and set(query) - ASYNC_LIST_PARAMS:
+        # filtered and sorted lists are served by the Flask app
+        handler = None
+    if handler is None:
+        await wsgi_app(scope, receive, send)
+        return
+    await serve(scope, receive, send, handler, arguments, query)
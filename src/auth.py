@@ -0,0 +1,166 @@
+"""
+Signup, login and JWT validation.
+
+Passwords are stored with a tunable KDF (PASSWORD_HASH_METHOD, see
+benchmarks/kdf.py to pick its cost); legacy plaintext rows and hashes made with
+an older cost are re-hashed on the next successful login. Protected routes trust
+the signed claims of the token and only need the user's current token version,
+which is kept in a small TTL cache so polling /valid-token does not hit the
+database.
+"""
+import hmac
+import os
+from functools import lru_cache
+from flask import jsonify, request
+from flask_jwt_extended import create_access_token, get_jwt, get_jwt_identity, jwt_required, JWTManager
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.security import check_password_hash, generate_password_hash
+from cache import LocalCache
+from models import db, User
+from utils import APIException
+
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+HASH_PREFIXES = ("scrypt:", "pbkdf2:")
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", 30))
+
+# user id -> (token version,) or (None,) for a user that does not exist
+user_states = LocalCache(max_entries=int(os.getenv("AUTH_CACHE_MAX_ENTRIES", 10000)), ttl=AUTH_CACHE_TTL)
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+@lru_cache(maxsize=1)
+def dummy_hash():
+    return hash_password("not a real password")
+
+
+def verify_password(user, password):
+    """Checks `password` against the stored one, returns (ok, needs rehash)"""
+    stored = user.password or ""
+    if not stored.startswith(HASH_PREFIXES):
+        # stored in plaintext before passwords were hashed
+        return hmac.compare_digest(stored.encode(), password.encode()), True
+    method = stored.split("$", 1)[0]
+    return check_password_hash(stored, password), method != PASSWORD_HASH_METHOD
+
+
+def user_state(user_id):
+    state = user_states.get(user_id)
+    if state is None:
+        user = db.session.get(User, user_id)
+        state = (None,) if user is None else (user.token_version,)
+        user_states.set(user_id, state)
+    return state[0]
+
+
+# Forget the cached state of users written by this process as soon as the write
+# commits; changes made elsewhere are picked up when the entry expires
+@event.listens_for(Session, "after_flush")
+def _collect_user_changes(session, flush_context):
+    changed = session.info.setdefault("auth_changed_users", set())
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, User):
+            changed.add(instance.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _forget_user_states(session):
+    for user_id in session.info.pop("auth_changed_users", ()):
+        user_states.delete(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _keep_user_states(session):
+    session.info.pop("auth_changed_users", None)
+
+
+def read_credentials():
+    data = request.get_json(silent=True) or {}
+    userName = data.get("userName")
+    password = data.get("password")
+    if not isinstance(userName, str) or not isinstance(password, str) or not userName or not password:
+        raise APIException("userName and password are required", status_code=400)
+    return data, userName, password
+
+
+def setup_auth(app):
+    app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY", "super-secret")  # Change this!
+    jwt = JWTManager(app)
+
+    @jwt.token_in_blocklist_loader
+    def token_revoked(jwt_header, jwt_payload):
+        # tokens of deleted users, and tokens issued before the user logged out everywhere
+        if not str(jwt_payload["sub"]).isdigit():
+            return True  # issued before identities were user ids
+        version = user_state(int(jwt_payload["sub"]))
+        return version is None or jwt_payload.get("ver", 0) != version
+
+    @jwt.revoked_token_loader
+    def revoked_token(jwt_header, jwt_payload):
+        return jsonify({"msg": "Token has been revoked", "estado": False}), 401
+
+    # JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT JWT
+    @app.route("/signup", methods=["POST"])
+    def signup():
+        data, userName, password = read_credentials()
+        email = data.get("email")
+        if not isinstance(email, str) or "@" not in email:
+            raise APIException("a valid email is required", status_code=400)
+        for field, value in (("userName", userName), ("email", email)):
+            if len(value) > User.__table__.c[field].type.length:
+                raise APIException("%s can be at most %d characters" % (field, User.__table__.c[field].type.length),
+                                   status_code=400)
+        # /login takes the first user of a name, a second one could never log in
+        if User.query.filter_by(userName=userName).first() is not None:
+            raise APIException("userName is already taken", status_code=409)
+        new_signup = User(userName=userName, email=email, password=hash_password(password))
+        db.session.add(new_signup)
+        db.session.commit()
+        return jsonify({"msg": "User signed up successfully"}), 200
+
+    # Create a route to authenticate your users and return JWTs. The
+    # create_access_token() function is used to actually generate the JWT.
+    @app.route("/login", methods=["POST"])
+    def login():
+        data, userName, password = read_credentials()
+        user = User.query.filter_by(userName=userName).first()
+        if user is None:
+            # spend the same time as a real check so unknown names can't be told apart
+            check_password_hash(dummy_hash(), password)
+            return jsonify({"msg": "Bad username or password"}), 401
+        ok, needs_rehash = verify_password(user, password)
+        if not ok:
+            return jsonify({"msg": "Bad username or password"}), 401
+        if needs_rehash:
+            user.password = hash_password(password)
+            db.session.commit()
+
+        access_token = create_access_token(identity=str(user.id),
+                                           additional_claims={"userName": user.userName, "ver": user.token_version})
+        return jsonify(access_token=access_token), 200
+
+    # Revoke every token of the current user
+    @app.route("/logout", methods=["POST"])
+    @jwt_required()
+    def logout():
+        user = db.session.get(User, int(get_jwt_identity()))
+        user.token_version = user.token_version + 1
+        db.session.commit()
+        return jsonify({"msg": "Logged out"}), 200
+
+    # Protect a route with jwt_required, which will kick out requests
+    # without a valid JWT present.
+    @app.route("/private", methods=["GET"])
+    @jwt_required()
+    def protected():
+        return jsonify(logged_in_as=get_jwt()["userName"]), 200
+
+    # Polled by the front-end: the signature, expiry and the cached user state are
+    # all it takes, no query in the common case
+    @app.route("/valid-token", methods=["GET"])
+    @jwt_required()
+    def valid_token():
+        return jsonify({"estado": True}), 200
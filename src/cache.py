@@ -0,0 +1,347 @@
+"""
+Read-through response cache for the catalogue GET endpoints.
+
+Entries are keyed by route, query string and the current "version" of every
+table the view reads. Committing a change to a table bumps its version, so
+stale entries are never looked up again and simply age out of the LRU.
+
+Conditional GETs: with a shared backend (CACHE_REDIS_URL) every worker sees the
+same versions, so they make the ETag and a 304 is answered without running the
+view. A local backend only sees the writes of its own process, so the tag is a
+hash of the response body instead: the same in every worker for the same
+content, new as soon as the content changes. The view still runs (for @cached
+views that is a cache hit), only the body is saved.
+
+Clients that accept gzip or brotli get a compressed copy of the entry, made on
+the first such request and stored next to it (see compression.py).
+
+Read replicas (replicas.py) may lag behind the primary for a few seconds after
+a commit bumped the versions: a response read from a replica in that window is
+neither stored nor given a version ETag, the stale body would outlive the lag.
+"""
+import hashlib
+import math
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import parse_qsl, urlencode
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from compression import compression, mark_encoded
+from metrics import Counter, Ratio
+
+
+class LocalCache:
+    """In-process LRU with a TTL per entry and a bounded number of entries"""
+
+    shared = False
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # versions are kept apart from the LRU: evicting one would reset it
+        # and make old entries reachable again
+        self._versions = {}
+        self._written_at = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (ttl or self.ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_versions(self, names):
+        with self._lock:
+            return [self._versions.get(name, 0) for name in names]
+
+    def bump_version(self, name):
+        with self._lock:
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+    def mark_written(self, name, ttl):
+        with self._lock:
+            self._written_at[name] = time.time()
+
+    def last_written(self, names):
+        with self._lock:
+            return max([self._written_at.get(name, 0) for name in names] or [0])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self._written_at.clear()
+
+
+class RedisCache:
+    """Shared backend so every gunicorn worker sees the same entries and versions"""
+
+    shared = True
+
+    def __init__(self, url, ttl=60, prefix="swapi:"):
+        import redis  # optional dependency, only needed when CACHE_REDIS_URL is set
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return None if raw is None else pickle.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def get_versions(self, names):
+        values = self.client.mget([self.prefix + "version:" + name for name in names])
+        return [int(value or 0) for value in values]
+
+    def bump_version(self, name):
+        self.client.incr(self.prefix + "version:" + name)
+
+    def mark_written(self, name, ttl):
+        self.client.set(self.prefix + "written_at:" + name, repr(time.time()), ex=max(1, math.ceil(ttl)))
+
+    def last_written(self, names):
+        values = self.client.mget([self.prefix + "written_at:" + name for name in names])
+        return max([float(value or 0) for value in values] or [0])
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+class ResponseCache:
+    def __init__(self, backend=None):
+        self.backend = backend or LocalCache()
+        self.enabled = True
+        self.configured = False
+        # seconds a read replica may stay behind a commit, set by setup_replicas
+        self.replica_lag = 0
+
+    def versions(self, tables):
+        return self.backend.get_versions(tables)
+
+    def invalidate(self, *tables):
+        for table in tables:
+            self.backend.bump_version(table)
+            if self.replica_lag:
+                self.backend.mark_written(table, self.replica_lag)
+
+    def replica_may_lag(self, tables):
+        """True when the current request reads from a replica that may not have
+        the last commit to one of `tables` yet: its response must not be stored,
+        nor tagged with the versions that commit bumped"""
+        if not self.replica_lag or not has_request_context() or g.get("db_replica") is None:
+            return False
+        return time.time() - self.backend.last_written(tables) < self.replica_lag
+
+    def key_for(self, tables, path=None, query_string=None):
+        """Key of the response to `path` and `query_string` (bytes), those of the
+        current request by default"""
+        if path is None:
+            path, query_string = request.path, request.query_string
+        versions = ",".join(str(version) for version in self.versions(tables))
+        # parameters in name order; the values of a repeated one keep their order,
+        # ?limit=1&limit=3 and ?limit=3&limit=1 are different requests
+        arguments = parse_qsl(query_string.decode("utf-8", "replace"), keep_blank_values=True)
+        query = urlencode(sorted(arguments, key=lambda argument: argument[0]))
+        return "response:%s?%s@%s" % (path, query, versions)
+
+    def etag_for(self, tables, path=None, query_string=None):
+        """ETag known before the response is built, None unless the backend is
+        shared: versions of a local backend only count this process' writes"""
+        if not getattr(self.backend, "shared", False) or self.replica_may_lag(tables):
+            return None
+        return hashlib.sha1(self.key_for(tables, path, query_string).encode("utf-8")).hexdigest()
+
+
+def body_etag(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+CACHE_CONTROL_MAX_AGE = int(os.getenv("CACHE_CONTROL_MAX_AGE", 30))
+
+response_cache = ResponseCache()
+
+CACHE_REQUESTS = Counter("response_cache_requests_total", "Lookups of the response cache, by endpoint and outcome")
+Ratio("response_cache_hit_ratio", "Share of response cache lookups that were hits, by endpoint", CACHE_REQUESTS)
+
+
+def cache_lookup(key, encoding):
+    """(entry, encoding of its body) stored under `key`: the copy compressed with
+    `encoding` when there is one, the plain one otherwise, (None, None) on a miss"""
+    if encoding is not None:
+        entry = response_cache.backend.get("%s|%s" % (key, encoding))
+        if entry is not None:
+            return entry, encoding
+    return response_cache.backend.get(key), None
+
+
+def cache_store(key, entry, encoding):
+    """Stores the plain `entry` and returns the body to send, compressed (and the
+    compressed copy stored as well) when `encoding` is worth it"""
+    response_cache.backend.set(key, entry)
+    return compressed_copy(key, entry, encoding)
+
+
+def compressed_copy(key, entry, encoding):
+    """(body, encoding) to answer with for a plain `entry`; a compressed body is
+    stored, so later hits reuse the bytes"""
+    body, status, mimetype = entry
+    if encoding is None or not compression.worth_it(mimetype, len(body)):
+        return body, None
+    body = compression.compress(body, encoding)
+    response_cache.backend.set("%s|%s" % (key, encoding), (body, status, mimetype))
+    return body, encoding
+
+
+def cache_hit(entry, encoding=None):
+    body, status, mimetype = entry
+    response = current_app.response_class(body, status=status, mimetype=mimetype)
+    if encoding is not None:
+        mark_encoded(response, encoding)
+    response.headers["X-Cache"] = "HIT"
+    CACHE_REQUESTS.inc(endpoint=request.endpoint, outcome="hit")
+    return response
+
+
+def cached(*tables):
+    """Caches the response of a GET view until one of `tables` changes or the TTL expires"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not response_cache.enabled:
+                return view(*args, **kwargs)
+            key = response_cache.key_for(tables)
+            encoding = compression.negotiate(request.accept_encodings)
+            entry, stored_encoding = cache_lookup(key, encoding)
+            if stored_encoding is not None:
+                # compressed when it was stored, sent as it is
+                return cache_hit(entry, stored_encoding)
+            if entry is not None:
+                response = cache_hit(entry)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                response.headers["X-Cache"] = "MISS"
+                CACHE_REQUESTS.inc(endpoint=request.endpoint, outcome="miss")
+                if response.status_code not in (200, 404) or response.is_streamed:
+                    return response
+                if response_cache.replica_may_lag(tables):
+                    return response
+                entry = (response.get_data(), response.status_code, response.mimetype)
+                response_cache.backend.set(key, entry)
+            body, encoding = compressed_copy(key, entry, encoding)
+            if encoding is not None:
+                response.set_data(body)
+                mark_encoded(response, encoding)
+            return response
+        # read by the ASGI handlers (asgi.py) serving the same route
+        wrapper.cached_tables = tables
+        return wrapper
+    return decorator
+
+
+def cache_control(public):
+    return "%s, max-age=%d" % ("public" if public else "private", CACHE_CONTROL_MAX_AGE)
+
+
+def conditional(*tables, public=True):
+    """Adds a strong ETag (see the top of this module) and answers 304 Not
+    Modified when the client already has it"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = response_cache.etag_for(tables)
+            # weak comparison: compressed responses carry the weak form of the tag
+            if etag is not None and request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if etag is None:
+                    etag = body_etag(response.get_data())
+                    if request.if_none_match.contains_weak(etag):
+                        response = current_app.response_class(status=304)
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = cache_control(public)
+            return response
+        wrapper.etag_tables = tables
+        wrapper.etag_public = public
+        return wrapper
+    return decorator
+
+
+# Invalidation: remember which tables a session wrote to and bump their
+# versions once the transaction commits. This covers the API handlers and the
+# Flask-Admin views alike, since both go through db.session.
+@event.listens_for(Session, "after_flush")
+def _collect_written_tables(session, flush_context):
+    touched = session.info.setdefault("written_tables", set())
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(instance, "__tablename__", None)
+        if table is not None:
+            touched.add(table)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _collect_statement_tables(orm_execute_state):
+    # INSERT/UPDATE/DELETE statements run through session.execute() skip the flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = orm_execute_state.statement.table
+        orm_execute_state.session.info.setdefault("written_tables", set()).add(table.name)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_written_tables(session):
+    touched = session.info.pop("written_tables", None)
+    if touched:
+        response_cache.invalidate(*touched)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_written_tables(session):
+    session.info.pop("written_tables", None)
+
+
+def setup_cache(app):
+    # the backend is set up once per process: an app created later in the same
+    # process (the admin app of wsgi.LazyAdmin) shares its entries and table
+    # versions instead of restarting them at 0 and answering 304 to old ETags
+    if not response_cache.configured:
+        ttl = int(os.getenv("CACHE_TTL", 60))
+        redis_url = os.getenv("CACHE_REDIS_URL")
+        if redis_url:
+            response_cache.backend = RedisCache(redis_url, ttl=ttl)
+        else:
+            response_cache.backend = LocalCache(max_entries=int(os.getenv("CACHE_MAX_ENTRIES", 1024)), ttl=ttl)
+        response_cache.enabled = os.getenv("CACHE_DISABLED", "0") != "1"
+        response_cache.configured = True
+    app.extensions["response_cache"] = response_cache
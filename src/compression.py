@@ -0,0 +1,129 @@
+"""
+Negotiated response compression.
+
+JSON and text responses of at least COMPRESS_MIN_SIZE bytes are sent with
+Content-Encoding br (when the brotli package is installed) or gzip, whichever the
+client's Accept-Encoding prefers, at COMPRESS_LEVEL (gzip, 1-9) or
+COMPRESS_BROTLI_LEVEL (0-11). Streamed exports are compressed chunk by chunk.
+
+The response cache (cache.py) keeps the compressed body of an entry next to the
+plain one, one copy per encoding, so a hit sends stored bytes and the same body
+is never compressed twice. A compressed response carries a weak ETag: it is the
+same resource as the plain one, not the same bytes.
+"""
+import gzip
+import os
+import zlib
+from flask import request
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/x-ndjson", "application/javascript", "application/xml")
+
+
+def compressible_mimetype(mimetype):
+    return bool(mimetype) and (mimetype.startswith("text/") or mimetype in COMPRESSIBLE_MIMETYPES)
+
+
+class Compression:
+    def __init__(self, min_size=1024, level=6, brotli_level=5):
+        self.min_size = min_size
+        self.level = level
+        self.brotli_level = brotli_level
+        self.enabled = True
+        self.configured = False
+
+    def encodings(self):
+        """Supported encodings, the preferred one first"""
+        return ("br", "gzip") if brotli is not None else ("gzip",)
+
+    def negotiate(self, accept_encodings):
+        """Encoding to answer with for a parsed Accept-Encoding, None for the plain body"""
+        if not self.enabled:
+            return None
+        best, best_quality = None, 0
+        for encoding in self.encodings():
+            quality = accept_encodings[encoding]
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def negotiate_header(self, value):
+        return self.negotiate(parse_accept_header(value or ""))
+
+    def worth_it(self, mimetype, size):
+        return compressible_mimetype(mimetype) and size >= self.min_size
+
+    def compress(self, data, encoding):
+        if encoding == "br":
+            return brotli.compress(data, quality=self.brotli_level)
+        # mtime=0: the same body always compresses to the same bytes
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def compress_stream(self, chunks, encoding):
+        """Compresses an iterable of chunks, flushing after each one so the client
+        keeps receiving data while it is produced"""
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=self.brotli_level)
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                yield compressor.process(chunk) + compressor.flush()
+            yield compressor.finish()
+            return
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)  # 31: gzip container
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+compression = Compression()
+
+
+def mark_encoded(response, encoding):
+    """Headers of a response whose body is already compressed with `encoding`"""
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+
+
+def setup_compression(app):
+    # settings are read once per process, every app created afterwards shares them
+    if not compression.configured:
+        compression.min_size = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+        compression.level = int(os.getenv("COMPRESS_LEVEL", 6))
+        compression.brotli_level = int(os.getenv("COMPRESS_BROTLI_LEVEL", 5))
+        compression.enabled = os.getenv("COMPRESS_DISABLED", "0") != "1"
+        compression.configured = True
+    app.extensions["compression"] = compression
+
+    @app.after_request
+    def compress_response(response):
+        if not compression.enabled or not compressible_mimetype(response.mimetype):
+            return response
+        response.vary.add("Accept-Encoding")
+        if "Content-Encoding" not in response.headers:
+            if (response.status_code < 200 or response.status_code in (204, 304)
+                    or request.method == "HEAD" or response.direct_passthrough):
+                return response
+            encoding = compression.negotiate(request.accept_encodings)
+            if encoding is None:
+                return response
+            if response.is_streamed:
+                response.response = compression.compress_stream(response.response, encoding)
+                response.headers.pop("Content-Length", None)
+            else:
+                data = response.get_data()
+                if len(data) < compression.min_size:
+                    return response
+                response.set_data(compression.compress(data, encoding))
+            mark_encoded(response, encoding)
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
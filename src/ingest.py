@@ -0,0 +1,217 @@
+"""
+Bulk loading of characters, planets and vehicles, from the API (POST /bulk/<resource>,
+logged in users, at most INGEST_MAX_ROWS rows a request) or the command line
+(pipenv run ingest characters characters.ndjson).
+
+Rows are validated one by one, against the type, length and range of their
+column, and written in batches: a multi-row executemany INSERT, or COPY ... FROM
+STDIN on PostgreSQL, with a commit per batch.
+"""
+import csv
+import io
+import json
+import os
+import click
+from flask import request, jsonify
+from flask_jwt_extended import jwt_required
+from sqlalchemy import BigInteger, SmallInteger
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+from models import db, Characters, Planets, Vehicles
+from cache import response_cache
+from utils import APIException
+
+# resource -> (model, {field: (type, required)})
+INGEST_RESOURCES = {
+    "characters": (Characters, {"name": (str, True), "race": (str, True), "homeworld": (str, True)}),
+    "planets": (Planets, {"name": (str, True), "population": (int, False), "averageTemp": (int, False)}),
+    "vehicles": (Vehicles, {"name": (str, True), "length": (int, False), "crewSize": (int, False)}),
+}
+FORMATS = ("json", "ndjson", "csv")
+DEFAULT_BATCH_SIZE = 5000
+MAX_REPORTED_REJECTS = 100
+MAX_ROWS = int(os.getenv("INGEST_MAX_ROWS", 50000))
+
+
+def read_rows(stream, input_format):
+    """Yields dicts from a text stream; ndjson and csv are read line by line"""
+    if input_format == "json":
+        rows = json.load(stream)
+        if not isinstance(rows, list):
+            raise ValueError("a JSON body must be an array of objects")
+        yield from rows
+    elif input_format == "ndjson":
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    elif input_format == "csv":
+        yield from csv.DictReader(stream)
+    else:
+        raise ValueError("format must be one of %s" % ", ".join(FORMATS))
+
+
+def at_most(rows, limit):
+    """`rows`, read in full before the first one is handed out: 413 when there
+    are more than `limit`, so an oversized request writes nothing"""
+    buffered = []
+    unreadable = None
+    try:
+        for row in rows:
+            if len(buffered) == limit:
+                raise APIException("at most %d rows per request, use the ingest command for more" % limit,
+                                   status_code=413)
+            buffered.append(row)
+    except ValueError as error:
+        # reported by ingest() after the rows read so far, as when streaming
+        unreadable = error
+    yield from buffered
+    if unreadable is not None:
+        raise unreadable
+
+
+def int_bounds(column_type):
+    bits = 64 if isinstance(column_type, BigInteger) else 16 if isinstance(column_type, SmallInteger) else 32
+    return -2 ** (bits - 1), 2 ** (bits - 1) - 1
+
+
+def clean_row(row, fields, columns):
+    """The row as column values, ValueError when a value does not fit its column"""
+    if not isinstance(row, dict):
+        raise ValueError("row is not an object")
+    cleaned = {}
+    for field, (field_type, required) in fields.items():
+        value = row.get(field)
+        if value in (None, ""):
+            if required:
+                raise ValueError("%s is required" % field)
+            cleaned[field] = None
+            continue
+        if isinstance(value, (bool, dict, list)) or (field_type is int and isinstance(value, float) and not value.is_integer()):
+            raise ValueError("%s must be of type %s" % (field, field_type.__name__))
+        try:
+            cleaned[field] = field_type(value)
+        except (TypeError, ValueError):
+            raise ValueError("%s must be of type %s" % (field, field_type.__name__))
+        column_type = columns[field].type
+        if field_type is str and column_type.length is not None and len(cleaned[field]) > column_type.length:
+            raise ValueError("%s can be at most %d characters" % (field, column_type.length))
+        if field_type is int:
+            low, high = int_bounds(column_type)
+            if not low <= cleaned[field] <= high:
+                raise ValueError("%s must be between %d and %d" % (field, low, high))
+    return cleaned
+
+
+def copy_rows(table, batch):
+    """COPY a batch into PostgreSQL through the session's psycopg2 connection"""
+    columns = list(batch[0].keys())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in batch:
+        writer.writerow(["" if row[column] is None else row[column] for column in columns])
+    buffer.seek(0)
+    preparer = db.session.get_bind().dialect.identifier_preparer
+    statement = "COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (
+        preparer.format_table(table), ", ".join(preparer.quote(column) for column in columns))
+    cursor = db.session.connection().connection.cursor()
+    dbapi_error = db.session.get_bind().dialect.dbapi.Error
+    try:
+        cursor.copy_expert(statement, buffer)
+    except dbapi_error as error:
+        # raw cursor: wrap the driver's error the way SQLAlchemy would
+        raise DBAPIError.instance(statement, None, error, dbapi_error)
+    finally:
+        cursor.close()
+
+
+def write_batch(table, batch):
+    bind = db.session.get_bind()
+    if bind.dialect.name == "postgresql" and bind.dialect.driver == "psycopg2":
+        copy_rows(table, batch)
+        response_cache.invalidate(table.name)
+    else:
+        db.session.execute(db.insert(table), batch)
+    db.session.commit()
+
+
+def ingest(rows, resource, batch_size=DEFAULT_BATCH_SIZE):
+    """Validates and inserts `rows`, returns a summary with the rejected rows.
+    A batch the database refuses is rolled back and reported as rejected as a
+    whole, the batches before and after it are kept"""
+    model, fields = INGEST_RESOURCES[resource]
+    inserted = 0
+    rejected = 0
+    errors = []
+    batch = []
+    batch_rows = []
+    row_number = 0
+
+    def flush():
+        nonlocal inserted, rejected
+        try:
+            write_batch(model.__table__, batch)
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            rejected += len(batch)
+            if len(errors) < MAX_REPORTED_REJECTS:
+                errors.append({"rows": [batch_rows[0], batch_rows[-1]],
+                               "error": "batch rejected: %s" % getattr(error, "orig", error)})
+        else:
+            inserted += len(batch)
+        batch.clear()
+        batch_rows.clear()
+
+    try:
+        for row_number, row in enumerate(rows, start=1):
+            try:
+                batch.append(clean_row(row, fields, model.__table__.c))
+            except ValueError as error:
+                rejected += 1
+                if len(errors) < MAX_REPORTED_REJECTS:
+                    errors.append({"row": row_number, "error": str(error)})
+                continue
+            batch_rows.append(row_number)
+            if len(batch) >= batch_size:
+                flush()
+    except ValueError as error:
+        # the stream itself is broken (bad JSON line...): keep what was loaded so far
+        rejected += 1
+        errors.append({"row": row_number + 1, "error": "unreadable input: %s" % error})
+    if batch:
+        flush()
+    return {"resource": resource, "inserted": inserted, "rejected": rejected, "errors": errors}
+
+
+def setup_ingest(app):
+
+    # Endpoint for bulk loading, the format comes from ?format= or the Content-Type
+    @app.route('/bulk/<resource>', methods=['POST'])
+    @jwt_required()
+    def bulk_create(resource):
+        if resource not in INGEST_RESOURCES:
+            return jsonify({"msg": "No resource with that name"}), 404
+        input_format = request.args.get("format") or {
+            "application/x-ndjson": "ndjson",
+            "text/csv": "csv",
+        }.get(request.mimetype, "json")
+        if input_format not in FORMATS:
+            raise APIException("format must be one of %s" % ", ".join(FORMATS), status_code=400)
+        batch_size = request.args.get("batch_size", DEFAULT_BATCH_SIZE, type=int)
+        if batch_size < 1:
+            raise APIException("batch_size must be greater than 0", status_code=400)
+        stream = io.TextIOWrapper(request.stream, encoding="utf-8")
+        rows = at_most(read_rows(stream, input_format), MAX_ROWS)
+        return jsonify(ingest(rows, resource, batch_size)), 200
+
+    @app.cli.command("ingest")
+    @click.argument("resource", type=click.Choice(list(INGEST_RESOURCES)))
+    @click.argument("source", type=click.File("r", encoding="utf-8"))
+    @click.option("--format", "input_format", type=click.Choice(FORMATS), default=None,
+                  help="Input format, guessed from the file extension by default")
+    @click.option("--batch-size", default=DEFAULT_BATCH_SIZE, show_default=True, type=click.IntRange(min=1))
+    def ingest_command(resource, source, input_format, batch_size):
+        """Bulk load RESOURCE rows from SOURCE (a file path or - for stdin)"""
+        if input_format is None:
+            extension = source.name.rsplit(".", 1)[-1].lower()
+            input_format = extension if extension in FORMATS else "ndjson"
+        summary = ingest(read_rows(source, input_format), resource, batch_size)
+        click.echo(json.dumps(summary, indent=2))
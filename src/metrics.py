@@ -0,0 +1,311 @@
+"""
+Minimal Prometheus-style metrics: counters, gauges and histograms rendered in the
+text exposition format on GET /metrics, plus per-route HTTP metrics.
+
+Counters and histograms are recorded without locks: every thread updates its own
+shard and a scrape adds the shards up. The shard of a thread that ended is folded
+into a total of the metric, threads come and go with a thread per request. With several gunicorn workers set
+PROMETHEUS_MULTIPROC_DIR to an empty directory shared by them: each worker
+writes its values there every METRICS_FLUSH_INTERVAL seconds and a scrape of any
+worker reports the sum of all of them (see gunicorn.conf.py for the hooks).
+"""
+import atexit
+import bisect
+import itertools
+import json
+import os
+import threading
+import time
+import weakref
+from flask import Response, g, request
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+REGISTRY = []
+
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 5))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('"', '\\"')) for name, value in labels)
+
+
+class _ShardOwner:
+    """Kept in a thread's local storage, freed when the thread ends"""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._local = threading.local()
+        self._shards = {}
+        # {labels: value} of the threads that ended
+        self._retired = {}
+        self._shard_ids = itertools.count()
+        # reentrant: a shard may be retired by whichever thread frees its owner
+        self._lock = threading.RLock()
+        REGISTRY.append(self)
+
+    def header(self):
+        return ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.kind)]
+
+    def _values(self):
+        """This thread's {labels: value}, nobody else writes to it"""
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                shard_id = next(self._shard_ids)
+                self._shards[shard_id] = values
+            # the thread-local owner goes away with the thread
+            self._local.owner = _ShardOwner()
+            weakref.finalize(self._local.owner, self._retire, shard_id)
+            return values
+
+    def _retire(self, shard_id):
+        with self._lock:
+            for key, value in self._shards.pop(shard_id).items():
+                self._retired[key] = self.add(self._retired.get(key), value)
+
+    def collect(self):
+        """{labels: value} of this process, the shards added up"""
+        with self._lock:
+            shards = list(self._shards.values())
+            totals = {key: self.add(None, value) for key, value in self._retired.items()}
+        for shard in shards:
+            # dict() copies in one step under the GIL, the owner may keep writing
+            for key, value in dict(shard).items():
+                totals[key] = self.add(totals.get(key), value)
+        return totals
+
+    def add(self, total, value):
+        return value if total is None else total + value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        values = self._values()
+        values[key] = values.get(key, 0) + amount
+
+    def render(self, values):
+        return ["%s%s %s" % (self.name, format_labels(key), value) for key, value in sorted(values.items())]
+
+
+class Gauge(Metric):
+    """Value read at scrape time from `callback`, which returns {labels tuple: value}.
+
+    With several workers `multiprocess_mode` says how their values combine: "all"
+    keeps one series per worker (a pid label), "sum" adds them up."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, callback, multiprocess_mode="all"):
+        super().__init__(name, documentation)
+        self.callback = callback
+        self.multiprocess_mode = multiprocess_mode
+
+    def collect(self):
+        return dict(self.callback())
+
+    def render(self, values):
+        return ["%s%s %s" % (self.name, format_labels(key), value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        values = self._values()
+        entry = values.get(key)
+        if entry is None:
+            # a count per bucket, the +Inf one last, then the sum
+            entry = values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def add(self, total, value):
+        value = list(value)
+        return value if total is None else [a + b for a, b in zip(total, value)]
+
+    def render(self, values):
+        lines = []
+        for key, entry in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), entry[:-1]):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(key + (("le", bound),)), cumulative))
+            lines.append("%s_sum%s %s" % (self.name, format_labels(key), entry[-1]))
+            lines.append("%s_count%s %d" % (self.name, format_labels(key), cumulative))
+        return lines
+
+
+class Ratio(Metric):
+    """hits / (hits + misses) of a counter with an `outcome` label, computed at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, counter, hit="hit"):
+        super().__init__(name, documentation)
+        self.counter = counter
+        self.hit = hit
+
+    def collect(self):
+        return {}
+
+    def render(self, values):
+        # `values` are the counter's
+        totals = {}
+        for key, value in values.items():
+            labels = tuple(item for item in key if item[0] != "outcome")
+            hits, count = totals.get(labels, (0, 0))
+            totals[labels] = (hits + (value if ("outcome", self.hit) in key else 0), count + value)
+        return ["%s%s %s" % (self.name, format_labels(key), round(hits / count, 4))
+                for key, (hits, count) in sorted(totals.items()) if count]
+
+
+# Multiprocess: one JSON file per worker, written atomically
+
+def _encode(values):
+    return [[list(map(list, key)), value] for key, value in values.items()]
+
+
+def _decode(items):
+    return {tuple(tuple(pair) for pair in key): value for key, value in items}
+
+
+def _process_file(pid):
+    return os.path.join(MULTIPROC_DIR, "metrics_%d.json" % pid)
+
+
+def flush():
+    """Writes this worker's values to PROMETHEUS_MULTIPROC_DIR"""
+    data = {"pid": os.getpid(), "metrics": {}, "gauges": {}}
+    for metric in REGISTRY:
+        data["gauges" if isinstance(metric, Gauge) else "metrics"][metric.name] = _encode(metric.collect())
+    _write(os.getpid(), data)
+
+
+def _write(pid, data):
+    path = _process_file(pid)
+    with open(path + ".tmp", "w") as snapshot_file:
+        json.dump(data, snapshot_file)
+    os.replace(path + ".tmp", path)
+
+
+def mark_process_dead(pid):
+    """Keeps the counters and histograms of a worker that exited, drops its gauges"""
+    try:
+        with open(_process_file(pid)) as snapshot_file:
+            data = json.load(snapshot_file)
+    except (OSError, ValueError):
+        return
+    data["gauges"] = {}
+    _write(pid, data)
+
+
+def _flush_forever():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
+
+
+_flusher_pid = None
+
+
+def start_flusher():
+    """Starts the flush thread of this process; safe to call from every request"""
+    global _flusher_pid
+    if MULTIPROC_DIR is None or _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_forever, name="metrics-flush", daemon=True).start()
+    atexit.register(flush)
+
+
+def collect_all():
+    """{metric name: {labels: value}} of this process, or of every worker"""
+    if MULTIPROC_DIR is None:
+        return {metric.name: metric.collect() for metric in REGISTRY}
+    flush()
+    snapshot = {metric.name: {} for metric in REGISTRY}
+    by_name = {metric.name: metric for metric in REGISTRY}
+    for filename in sorted(os.listdir(MULTIPROC_DIR)):
+        if not (filename.startswith("metrics_") and filename.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(MULTIPROC_DIR, filename)) as snapshot_file:
+                data = json.load(snapshot_file)
+        except (OSError, ValueError):
+            continue  # a worker replacing its file right now
+        for name, items in list(data["metrics"].items()) + list(data["gauges"].items()):
+            metric = by_name.get(name)
+            if metric is None:
+                continue
+            for key, value in _decode(items).items():
+                if isinstance(metric, Gauge) and metric.multiprocess_mode == "all":
+                    key = key + (("pid", data["pid"]),)
+                snapshot[name][key] = metric.add(snapshot[name].get(key), value)
+    return snapshot
+
+
+def render():
+    snapshot = collect_all()
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.header())
+        source = metric.counter if isinstance(metric, Ratio) else metric
+        lines.extend(metric.render(snapshot.get(source.name, {})))
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUESTS = Counter("http_requests_total", "Requests handled, by endpoint, method and status")
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time spent handling a request, by endpoint and method")
+HTTP_RESPONSE_BYTES = Histogram("http_response_size_bytes", "Size of the response bodies, by endpoint", buckets=SIZE_BUCKETS)
+HTTP_STARTED = Counter("http_requests_started_total", "Requests that started being handled")
+HTTP_FINISHED = Counter("http_requests_finished_total", "Requests that finished being handled")
+Gauge("http_requests_in_flight", "Requests being handled right now",
+      lambda: {(): sum(HTTP_STARTED.collect().values()) - sum(HTTP_FINISHED.collect().values())},
+      multiprocess_mode="sum")
+
+
+def setup_metrics(app):
+
+    @app.before_request
+    def start_request_timer():
+        start_flusher()
+        g.metrics_started = time.perf_counter()
+        HTTP_STARTED.inc()
+
+    @app.after_request
+    def record_request(response):
+        started = g.get("metrics_started")
+        if started is not None:
+            endpoint = request.endpoint or "not_found"
+            HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+            if response.content_length is not None:
+                HTTP_RESPONSE_BYTES.observe(response.content_length, endpoint=endpoint)
+        return response
+
+    @app.teardown_request
+    def finish_request(exception):
+        if g.pop("metrics_started", None) is not None:
+            HTTP_FINISHED.inc()
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
@@ -4,12 +4,62 @@
 # from sqlalchemy.orm import relationship, declarative_base
 # from sqlalchemy import create_engine
 # from eralchemy2 import render_er
+from flask import g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import event
 
 
-db = SQLAlchemy()
+class RoutingSession(FlaskSession):
+    """Sends the reads of a request to the replica replicas.py picked for it
+    (g.db_replica); flushes, INSERT/UPDATE/DELETE and SELECT ... FOR UPDATE, and
+    every read after them in the same request, go to the primary"""
 
-class Planets(db.Model):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context() and "db_replica" in g:
+            writes = self._flushing or getattr(clause, "is_dml", False) or getattr(clause, "_for_update_arg", None) is not None
+            if writes:
+                g.db_replica = None
+                g.db_wrote = True
+            elif g.db_replica is not None:
+                return g.db_replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+# SQLite ignores foreign keys unless asked, and the favourites write path relies
+# on the database rejecting rows that point to missing users. Only the engines of
+# the app (and of asgi.py) get this: Alembic turns it off while it rebuilds tables
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+def enforce_foreign_keys(engine):
+    if engine.dialect.name == "sqlite" and not event.contains(engine, "connect", _enable_sqlite_foreign_keys):
+        event.listen(engine, "connect", _enable_sqlite_foreign_keys)
+
+class Serializable:
+    # serialized key -> column attribute, in output order
+    serialized_fields = {}
+
+    def serialize(self):
+        return {key: getattr(self, attr) for key, attr in self.serialized_fields.items()}
+
+    # Fast path for lists: select only these columns as plain tuples
+    # (Model.query.with_entities(*Model.serialized_columns())) and build the dicts
+    # with serialize_row, without hydrating ORM objects
+    # with the serialized keys in `fields` only, when a sparse fieldset is asked for
+    @classmethod
+    def serialized_columns(cls, fields=None):
+        return [getattr(cls, cls.serialized_fields[key]) for key in (fields or cls.serialized_fields)]
+
+    @classmethod
+    def serialize_row(cls, row, fields=None):
+        return dict(zip(fields or cls.serialized_fields, row))
+
+class Planets(Serializable, db.Model):
     __tablename__ = 'planets'
     # Here we define db.Columns for the table person
     # Notice that each db.Column is also a normal Python instance attribute.
@@ -17,99 +67,153 @@ class Planets(db.Model):
     name = db.Column(db.String(250), nullable=False)
     population = db.Column(db.Integer)
     averageTemp = db.Column(db.Integer)
-    favourites = db.relationship('Favourites', backref='planets', lazy=True)
+    # filters and sorting of /planets, see LIST_FILTERS in app.py
+    __table_args__ = (
+        db.Index('ix_planets_name_id', 'name', 'id'),
+        db.Index('ix_planets_population_id', 'population', 'id'),
+        db.Index('ix_planets_averageTemp_id', 'averageTemp', 'id'),
+    )
 
     def __repr__(self):
         return '<Planets %r>' % self.name
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "population": self.population,
-            "average temp": self.averageTemp
-        }
+    serialized_fields = {
+        "id": "id",
+        "name": "name",
+        "population": "population",
+        "average temp": "averageTemp"
+    }
 
-class Characters(db.Model):
+class Characters(Serializable, db.Model):
     __tablename__ = 'characters'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250), nullable=False)
     race = db.Column(db.String(250), nullable=False)
     homeworld = db.Column(db.String(250), nullable=False)
-    favourites = db.relationship('Favourites', backref='characters', lazy=True)
+    # filters and sorting of /characters, see LIST_FILTERS in app.py
+    __table_args__ = (
+        db.Index('ix_characters_name_id', 'name', 'id'),
+        db.Index('ix_characters_race_id', 'race', 'id'),
+        db.Index('ix_characters_homeworld_id', 'homeworld', 'id'),
+    )
     
     def __repr__(self):
         return '<Characters %r>' % self.name
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "race": self.race,
-            "homeworld": self.homeworld
-        }
+    serialized_fields = {
+        "id": "id",
+        "name": "name",
+        "race": "race",
+        "homeworld": "homeworld"
+    }
 
-class Vehicles(db.Model):
+class Vehicles(Serializable, db.Model):
     __tablename__ = 'vehicles'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250), nullable=False)
     length = db.Column(db.Integer)
     crewSize = db.Column(db.Integer)
-    favourites = db.relationship('Favourites', backref='vehicles', lazy=True)
+    # filters and sorting of /vehicles, see LIST_FILTERS in app.py
+    __table_args__ = (
+        db.Index('ix_vehicles_name_id', 'name', 'id'),
+        db.Index('ix_vehicles_length_id', 'length', 'id'),
+        db.Index('ix_vehicles_crewSize_id', 'crewSize', 'id'),
+    )
 
     def __repr__(self):
         return '<Vehicles %r>' % self.name
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "length (metres)": self.length,
-            "crew size": self.crewSize
-        }
+    serialized_fields = {
+        "id": "id",
+        "name": "name",
+        "length (metres)": "length",
+        "crew size": "crewSize"
+    }
 
 
 
 class Favourites(db.Model):
     __tablename__ = 'favourites'
     id = db.Column(db.Integer, primary_key=True)
-    favouritePlanets_id = db.Column(db.Integer, db.ForeignKey('planets.id'))
-    favouriteCharacters_id = db.Column(db.Integer, db.ForeignKey('characters.id'))
-    favouriteVehicles_id = db.Column(db.Integer, db.ForeignKey('vehicles.id'))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    
+    # what is favourited: kind is a key of FAVOURITE_KINDS in app.py ("characters",
+    # "planets" or "vehicles") and target_id the id of the row in that table
+    kind = db.Column(db.String(16), nullable=False)
+    target_id = db.Column(db.Integer, nullable=False)
+    # listing a user's favourites is an index range scan instead of a full table scan;
+    # (user_id, kind, target_id) keeps a favourite unique and answers every lookup,
+    # add and delete of one favourite from the index alone
+    __table_args__ = (
+        db.Index('ix_favourites_user_id_id', 'user_id', 'id'),
+        db.UniqueConstraint('user_id', 'kind', 'target_id', name='uq_favourites_user_kind_target'),
+        db.CheckConstraint("kind IN ('characters', 'planets', 'vehicles')", name='ck_favourites_kind'),
+    )
+    planets = db.relationship('Planets', viewonly=True,
+                              primaryjoin="and_(Favourites.kind == 'planets', foreign(Favourites.target_id) == Planets.id)")
+    characters = db.relationship('Characters', viewonly=True,
+                                 primaryjoin="and_(Favourites.kind == 'characters', foreign(Favourites.target_id) == Characters.id)")
+    vehicles = db.relationship('Vehicles', viewonly=True,
+                               primaryjoin="and_(Favourites.kind == 'vehicles', foreign(Favourites.target_id) == Vehicles.id)")
 
     def __repr__(self):
         return '<Favourites %r>' % self.id
 
+    # load the targets with Favourites.query.options(*Favourites.eager_targets())
+    # or every row below fires its own SELECT
+    @staticmethod
+    def eager_targets():
+        return (
+            db.joinedload(Favourites.planets),
+            db.joinedload(Favourites.characters),
+            db.joinedload(Favourites.vehicles),
+        )
+
     def serialize(self):
         return {
             "id": self.id,
-            # "planet": self.planets_id,
-            # "character": self.characters_id,
-            # "vehicle": self.vehicles_id
+            "user_id": self.user_id,
+            "planet": self.planets.serialize() if self.planets else None,
+            "character": self.characters.serialize() if self.characters else None,
+            "vehicle": self.vehicles.serialize() if self.vehicles else None
         }
 
 
-class User(db.Model):
+# target_id is not a foreign key, so deleting a planet, character or vehicle
+# deletes the favourites pointing to it here
+def _delete_favourites_of(kind):
+    def delete_favourites(mapper, connection, target):
+        connection.execute(Favourites.__table__.delete().where(
+            Favourites.kind == kind, Favourites.target_id == target.id))
+    return delete_favourites
+
+for _kind, _model in (("planets", Planets), ("characters", Characters), ("vehicles", Vehicles)):
+    event.listen(_model, "after_delete", _delete_favourites_of(_kind))
+
+
+class User(Serializable, db.Model):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
     userName = db.Column(db.String(25), nullable=False)
     email = db.Column(db.String(411), nullable=False)
-    password = db.Column(db.String(16), nullable=False)
+    password = db.Column(db.String(255), nullable=False)
     onlinestatus = db.Column(db.Boolean()) 
+    # bumped to revoke every token issued to the user so far
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     favourites = db.relationship('Favourites', backref='user', lazy=True)
+    # /login and the admin's user search look users up by name
+    __table_args__ = (
+        db.Index('ix_user_userName', 'userName'),
+    )
 
     def __repr__(self):
         return '<User %r>' % self.userName
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "user name": self.userName,
-            "email": self.email,
-            "online status": self.onlinestatus,
-            # "favourites": self.favourites -- ask about this --
-            # do not serialize the password, its a security breach
-        }
+    serialized_fields = {
+        "id": "id",
+        "user name": "userName",
+        "email": "email",
+        "online status": "onlinestatus",
+        # "favourites": self.favourites -- ask about this --
+        # do not serialize the password, its a security breach
+    }
 
@@ -0,0 +1,65 @@
+"""
+Connection pool settings for the SQLAlchemy engine, read from the environment,
+and pool metrics (checked out connections, overflow, checkout latency).
+"""
+import os
+import time
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from metrics import Counter, Gauge, Histogram
+
+POOL_CHECKOUT_SECONDS = Histogram(
+    "db_pool_checkout_seconds", "Time spent waiting for a connection from the pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30))
+POOL_TIMEOUTS = Counter("db_pool_timeouts_total", "Checkouts that gave up after pool_timeout")
+
+# pools created by InstrumentedQueuePool, read by the gauges at scrape time
+POOLS = []
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long every checkout waited"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        POOLS.append(self)
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+
+    def recreate(self):
+        POOLS.remove(self)
+        return super().recreate()
+
+
+def _pool_stats(stat):
+    return lambda: {(("pool", index),): getattr(pool, stat)() for index, pool in enumerate(POOLS)}
+
+
+Gauge("db_pool_size", "Configured number of persistent connections", _pool_stats("size"))
+Gauge("db_pool_checked_out", "Connections currently in use", _pool_stats("checkedout"))
+Gauge("db_pool_checked_in", "Idle connections in the pool", _pool_stats("checkedin"))
+Gauge("db_pool_overflow", "Connections opened above pool_size (negative while the pool is filling)", _pool_stats("overflow"))
+
+
+def engine_options(database_url):
+    """SQLALCHEMY_ENGINE_OPTIONS for `database_url`, sized per worker with DB_POOL_* variables"""
+    if database_url.startswith("sqlite") and (":memory:" in database_url or database_url.rstrip("/") == "sqlite:"):
+        # in-memory SQLite lives inside a single connection, leave its pool alone
+        return {}
+    return {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        # Render's PostgreSQL drops idle sockets, recycle before it does
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1") == "1",
+    }
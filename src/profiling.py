@@ -0,0 +1,103 @@
+"""
+Opt-in per-request SQL profiling (SQL_PROFILING=1).
+
+Counts the queries and DB time of every request, keeps its slowest statements,
+reports them in a Server-Timing header and a structured log line, and warns
+when a request goes over the query-count or latency budget.
+"""
+import json
+import logging
+import os
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger("sql_profile")
+
+SLOWEST_KEPT = 3
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and "sql_profile" in g:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _record(conn, statement)
+
+
+def _handle_error(exception_context):
+    # failed statements (e.g. an INSERT hitting a foreign key) count as well
+    if exception_context.connection is not None:
+        _record(exception_context.connection, exception_context.statement or "")
+
+
+def _record(conn, statement):
+    started = conn.info.get("query_started")
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    if not (has_request_context() and "sql_profile" in g):
+        return
+    profile = g.sql_profile
+    profile["count"] += 1
+    profile["seconds"] += elapsed
+    slowest = profile["slowest"]
+    slowest.append((elapsed, " ".join(statement.split())))
+    slowest.sort(key=lambda item: item[0], reverse=True)
+    del slowest[SLOWEST_KEPT:]
+
+
+ENGINE_LISTENERS = (
+    ("before_cursor_execute", _before_cursor_execute),
+    ("after_cursor_execute", _after_cursor_execute),
+    ("handle_error", _handle_error),
+)
+
+
+def profile_engine(engine):
+    """Times the statements of `engine`; listeners already in place are left alone,
+    so every query is counted once however many apps set profiling up"""
+    for name, listener in ENGINE_LISTENERS:
+        if not event.contains(engine, name, listener):
+            event.listen(engine, name, listener)
+
+
+def setup_profiling(app):
+    if os.getenv("SQL_PROFILING", "0") != "1":
+        return
+    query_budget = int(os.getenv("SQL_QUERY_BUDGET", 10))
+    latency_budget = float(os.getenv("SQL_LATENCY_BUDGET_MS", 200)) / 1000
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+        logger.setLevel(logging.INFO)
+    with app.app_context():
+        for engine in app.extensions["sqlalchemy"].engines.values():
+            profile_engine(engine)
+
+    @app.before_request
+    def start_profile():
+        g.sql_profile = {"count": 0, "seconds": 0.0, "slowest": [], "started": time.perf_counter()}
+
+    @app.after_request
+    def report_profile(response):
+        profile = g.pop("sql_profile", None)
+        if profile is None:
+            return response
+        total = time.perf_counter() - profile["started"]
+        response.headers.add("Server-Timing", 'db;dur=%.2f;desc="%d queries"' % (profile["seconds"] * 1000, profile["count"]))
+        response.headers.add("Server-Timing", "app;dur=%.2f" % (total * 1000))
+        over_budget = profile["count"] > query_budget or total > latency_budget
+        record = {
+            "method": request.method,
+            "path": request.path,
+            "endpoint": request.endpoint,
+            "status": response.status_code,
+            "queries": profile["count"],
+            "db_ms": round(profile["seconds"] * 1000, 2),
+            "total_ms": round(total * 1000, 2),
+            "slowest": [{"ms": round(seconds * 1000, 2), "sql": sql[:500]} for seconds, sql in profile["slowest"]],
+            "over_budget": over_budget,
+        }
+        logger.log(logging.WARNING if over_budget else logging.INFO, json.dumps(record))
+        return response
@@ -0,0 +1,251 @@
+"""
+Rate limiting and admission control.
+
+Every client (the user id of a valid bearer token, otherwise the remote address)
+gets a token bucket per route group: /login, /signup and the favourites writes
+are limited out of the box, RATELIMIT_DEFAULT adds a limit to every other route.
+Buckets live in process memory, or in Redis when RATELIMIT_STORAGE_URL is set so
+all gunicorn workers share them. Over the limit a request gets 429 with
+Retry-After.
+
+Admission control caps the requests a worker runs at once (by default the size
+of its DB pool). A few more may wait, for a bounded time, for a slot; the rest
+are shed right away with 503 and Retry-After instead of piling up on the pool.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import g, jsonify, request
+from flask_jwt_extended import decode_token
+from metrics import Counter, Gauge
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600}
+
+# endpoint -> (bucket group, limit); the routes of a group share one bucket per client
+ROUTE_LIMITS = {
+    "login": ("login", "10/minute"),
+    "signup": ("signup", "5/minute"),
+    "api.create_favourite": ("favourites", "120/minute"),
+    "api.delete_favourite": ("favourites", "120/minute"),
+    "api.batch_favourites": ("favourites", "120/minute"),
+    "bulk_create": ("bulk", "10/minute"),
+}
+EXEMPT_ENDPOINTS = ("metrics", "static")
+
+RATE_LIMIT_DECISIONS = Counter("ratelimit_requests_total", "Requests checked against a rate limit, by group and outcome")
+ADMISSION_SHED = Counter("admission_shed_total", "Requests answered 503 because the worker was at capacity, by reason")
+
+
+def parse_limit(limit):
+    """'10/minute' -> (refill rate per second, burst)"""
+    try:
+        count, period = limit.split("/")
+        return int(count) / PERIODS[period.strip()], int(count)
+    except (KeyError, ValueError):
+        raise ValueError("rate limits look like 10/second, 10/minute or 10/hour, not %r" % limit)
+
+
+class MemoryStore:
+    """Token buckets of this process, the least recently used ones are dropped first"""
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Takes a token from the bucket `key`, returns (allowed, seconds until the next token)"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+# refill and take atomically, on the Redis clock so every worker agrees on the time
+TAKE_SCRIPT = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisStore:
+    """Buckets shared by every worker. `client` can be any object with redis-py's
+    register_script(), e.g. a fakeredis instance in development"""
+
+    def __init__(self, url=None, client=None, prefix="swapi:ratelimit:"):
+        if client is None:
+            import redis  # optional dependency, only needed when RATELIMIT_STORAGE_URL is set
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    def take(self, key, rate, burst):
+        allowed, tokens = self._take(keys=[self.prefix + key], args=[rate, burst])
+        return bool(allowed), 0 if allowed else (1 - float(tokens)) / rate
+
+
+class RateLimiter:
+    def __init__(self, store=None, default=None):
+        self.store = store or MemoryStore()
+        self.default = parse_limit(default) if default else None
+        self.limits = {endpoint: (group, parse_limit(limit)) for endpoint, (group, limit) in ROUTE_LIMITS.items()}
+        self.enabled = True
+        self.configured = False
+
+    def hit(self, endpoint, client):
+        """Counts a request of `client` to `endpoint`, returns (allowed, retry after in seconds)"""
+        if endpoint in self.limits:
+            group, (rate, burst) = self.limits[endpoint]
+        elif self.default is not None:
+            group, (rate, burst) = "default", self.default
+        else:
+            return True, 0
+        allowed, retry_after = self.store.take("%s:%s" % (group, client), rate, burst)
+        RATE_LIMIT_DECISIONS.inc(group=group, outcome="allowed" if allowed else "limited")
+        return allowed, retry_after
+
+
+class AdmissionControl:
+    """At most `max_concurrent` requests at once, at most `max_queued` waiting up to `queue_timeout` seconds"""
+
+    def __init__(self, max_concurrent, max_queued, queue_timeout):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.enabled = True
+        self._condition = threading.Condition()
+
+    def try_acquire(self):
+        """Takes a free slot without waiting, False when there is none"""
+        with self._condition:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                return True
+            return False
+
+    def acquire(self):
+        """Returns None once admitted, otherwise why the request was shed"""
+        deadline = time.monotonic() + self.queue_timeout
+        with self._condition:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                return None
+            if self.waiting >= self.max_queued:
+                return "queue_full"
+            self.waiting += 1
+            try:
+                while self.active >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return "queue_timeout"
+                    self._condition.wait(remaining)
+                self.active += 1
+                return None
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+rate_limiter = RateLimiter()
+admission = AdmissionControl(
+    max_concurrent=int(os.getenv("ADMISSION_MAX_CONCURRENT",
+                                 int(os.getenv("DB_POOL_SIZE", 5)) + int(os.getenv("DB_MAX_OVERFLOW", 10)))),
+    max_queued=int(os.getenv("ADMISSION_MAX_QUEUED", 30)),
+    queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 5)),
+)
+
+Gauge("admission_in_flight", "Requests holding an admission slot", lambda: {(): admission.active},
+      multiprocess_mode="sum")
+Gauge("admission_queued", "Requests waiting for an admission slot", lambda: {(): admission.waiting},
+      multiprocess_mode="sum")
+
+
+def client_identity(authorization, remote_addr):
+    """The user id of a valid bearer token, else the remote address"""
+    if authorization and authorization.startswith("Bearer "):
+        try:
+            return "user:%s" % decode_token(authorization[len("Bearer "):])["sub"]
+        except Exception:
+            pass
+    return "ip:%s" % remote_addr
+
+
+def remote_address():
+    if os.getenv("RATELIMIT_TRUST_PROXY", "0") == "1" and request.access_route:
+        # behind Render's (or any) proxy the client is the first forwarded hop
+        return request.access_route[0]
+    return request.remote_addr
+
+
+def too_many_requests(retry_after):
+    response = jsonify({"msg": "Too many requests, slow down"})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def setup_ratelimit(app):
+    # once per process: a second app must not start the counters over
+    if not rate_limiter.configured:
+        if os.getenv("RATELIMIT_STORAGE_URL"):
+            rate_limiter.store = RedisStore(os.getenv("RATELIMIT_STORAGE_URL"))
+        if os.getenv("RATELIMIT_DEFAULT"):
+            rate_limiter.default = parse_limit(os.getenv("RATELIMIT_DEFAULT"))
+        rate_limiter.enabled = os.getenv("RATELIMIT_DISABLED", "0") != "1"
+        admission.enabled = os.getenv("ADMISSION_DISABLED", "0") != "1"
+        rate_limiter.configured = True
+
+    @app.before_request
+    def limit_request():
+        if request.method == "OPTIONS" or request.endpoint in EXEMPT_ENDPOINTS:
+            return None
+        if rate_limiter.enabled:
+            client = client_identity(request.headers.get("Authorization"), remote_address())
+            allowed, retry_after = rate_limiter.hit(request.endpoint, client)
+            if not allowed:
+                return too_many_requests(retry_after)
+        if admission.enabled:
+            shed_reason = admission.acquire()
+            if shed_reason is not None:
+                ADMISSION_SHED.inc(reason=shed_reason)
+                response = jsonify({"msg": "Server busy, try again later"})
+                response.status_code = 503
+                response.headers["Retry-After"] = "1"
+                return response
+            g.admitted = True
+        return None
+
+    @app.teardown_request
+    def release_slot(exception):
+        if g.pop("admitted", False):
+            admission.release()
@@ -0,0 +1,216 @@
+"""
+Read replicas: DATABASE_REPLICA_URLS (comma separated) adds read-only copies of
+DATABASE_URL.
+
+GET and HEAD requests read from one healthy replica, picked round robin;
+everything else, and any statement that writes, uses the primary (see
+RoutingSession in models.py). A client that wrote keeps reading from the primary
+for REPLICA_STICKY_SECONDS so it sees its own writes through the replication lag.
+
+A replica whose connections fail is ejected for REPLICA_EJECT_SECONDS, and
+every replica is probed (SELECT 1, plus the replay lag on PostgreSQL against
+REPLICA_MAX_LAG_SECONDS) at most every REPLICA_HEALTH_INTERVAL seconds. With no
+healthy replica reads fall back to the primary, and a GET whose replica fails
+mid-request is run again on the primary.
+
+The async handlers of asgi.py keep reading from the primary.
+
+A response read from a replica less than REPLICA_STICKY_SECONDS after a commit
+to one of its tables is not cached (see cache.py): it may predate that commit.
+
+For local development `flask replicas sync` copies a SQLite primary into SQLite
+replicas (`--every N` keeps doing it, a stand-in for replication with N seconds
+of lag); point DATABASE_REPLICA_URLS at a second PostgreSQL instance otherwise.
+"""
+import itertools
+import os
+import sqlite3
+import threading
+import time
+import click
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import InterfaceError, OperationalError
+from cache import LocalCache, response_cache
+from metrics import Counter, Gauge
+from pool import engine_options
+from ratelimit import client_identity, remote_address
+
+STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", 5))
+EJECT_SECONDS = float(os.getenv("REPLICA_EJECT_SECONDS", 30))
+HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", 10))
+MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", 30))
+STICKY_COOKIE = "read_primary_until"
+
+REPLICA_READS = Counter("db_reads_total", "GET requests by the database they read from")
+REPLICA_EJECTIONS = Counter("db_replica_ejections_total", "Times a replica was taken out of rotation, by replica and reason")
+
+LAG_QUERY = "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)"
+
+
+def replica_urls():
+    return [url.strip().replace("postgres://", "postgresql://")
+            for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+
+
+def replica_binds():
+    """SQLALCHEMY_BINDS entries of the replicas, bind key -> engine options"""
+    return {"replica_%d" % index: dict(engine_options(url), url=url) for index, url in enumerate(replica_urls())}
+
+
+class Replica:
+    def __init__(self, name, engine):
+        self.name = name
+        self.engine = engine
+        self.ejected_until = 0
+        self.checked_at = time.monotonic()
+        self._lock = threading.Lock()
+        event.listen(engine, "handle_error", self._on_error)
+
+    def _on_error(self, exception_context):
+        if exception_context.is_disconnect or exception_context.connection is None:
+            self.eject("connection_error")
+
+    def eject(self, reason):
+        self.ejected_until = time.monotonic() + EJECT_SECONDS
+        REPLICA_EJECTIONS.inc(replica=self.name, reason=reason)
+
+    def available(self):
+        now = time.monotonic()
+        if now < self.ejected_until:
+            return False
+        if now - self.checked_at >= HEALTH_INTERVAL and self._lock.acquire(blocking=False):
+            # one request per worker pays for the probe, the others go on meanwhile
+            try:
+                self.checked_at = now
+                self.probe()
+            finally:
+                self._lock.release()
+        return time.monotonic() >= self.ejected_until
+
+    def probe(self):
+        try:
+            with self.engine.connect() as connection:
+                if self.engine.dialect.name == "postgresql":
+                    lag = connection.exec_driver_sql(LAG_QUERY).scalar()
+                    if lag > MAX_LAG_SECONDS:
+                        self.eject("lag")
+                else:
+                    connection.exec_driver_sql("SELECT 1")
+        except Exception:
+            self.eject("probe_failed")
+
+
+class ReplicaSet:
+    def __init__(self):
+        self.replicas = []
+        self._turn = itertools.count()
+        self.configured = False
+
+    def configure(self, engines):
+        self.replicas = [Replica(name, engine) for name, engine in sorted(engines.items())]
+        self.configured = True
+
+    def choose(self):
+        """Engine of the next healthy replica, None when there is none"""
+        healthy = [replica for replica in self.replicas if replica.available()]
+        if not healthy:
+            return None
+        return healthy[next(self._turn) % len(healthy)].engine
+
+
+replica_set = ReplicaSet()
+
+# clients that wrote in the last STICKY_SECONDS, they read from the primary
+sticky_clients = LocalCache(max_entries=100000, ttl=STICKY_SECONDS)
+
+Gauge("db_replica_healthy", "1 while a replica is in rotation",
+      lambda: {(("replica", replica.name),): int(time.monotonic() >= replica.ejected_until)
+               for replica in replica_set.replicas})
+
+
+def sync_sqlite(primary_url, replica_url):
+    source = sqlite3.connect(make_url(primary_url).database)
+    target = sqlite3.connect(make_url(replica_url).database)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+def setup_replicas(app):
+    # the replicas are picked up once per process; an app created later (the
+    # admin app of wsgi.LazyAdmin) reads through the same set, health and all
+    if not replica_set.configured:
+        db = app.extensions["sqlalchemy"]
+        with app.app_context():
+            engines = {key: engine for key, engine in db.engines.items()
+                       if key is not None and key.startswith("replica_")}
+        replica_set.configure(engines)
+        if replica_set.replicas:
+            # replica reads in the window after a commit stay out of the response cache
+            response_cache.replica_lag = STICKY_SECONDS
+    app.extensions["replicas"] = replica_set
+
+    def reads_from_primary(client):
+        try:
+            if float(request.cookies.get(STICKY_COOKIE, 0)) > time.time():
+                return True
+        except ValueError:
+            pass
+        return sticky_clients.get(client) is not None
+
+    @app.before_request
+    def route_reads():
+        g.db_replica = None
+        if not replica_set.replicas or request.method not in ("GET", "HEAD"):
+            return
+        g.db_client = client_identity(request.headers.get("Authorization"), remote_address())
+        if not reads_from_primary(g.db_client):
+            g.db_replica = replica_set.choose()
+        REPLICA_READS.inc(target="primary" if g.db_replica is None else "replica")
+
+    @app.after_request
+    def stick_to_primary(response):
+        if g.get("db_wrote") and replica_set.replicas:
+            client = g.get("db_client") or client_identity(request.headers.get("Authorization"), remote_address())
+            sticky_clients.set(client, True)
+            # the cookie carries the stickiness to the other workers
+            response.set_cookie(STICKY_COOKIE, "%.3f" % (time.time() + STICKY_SECONDS),
+                                max_age=int(STICKY_SECONDS) + 1, httponly=True, samesite="Lax")
+        return response
+
+    def read_from_primary_instead(error):
+        # the replica went away under this request: it is ejected by now, run the
+        # (read-only) view again on the primary rather than answer 500
+        if g.get("db_replica") is None:
+            raise error
+        db.session.rollback()
+        g.db_replica = None
+        REPLICA_READS.inc(target="primary_after_replica_error")
+        return current_app.dispatch_request()
+
+    app.register_error_handler(OperationalError, read_from_primary_instead)
+    app.register_error_handler(InterfaceError, read_from_primary_instead)
+
+    @app.cli.group("replicas")
+    def replicas_command():
+        """Development stand-ins for read replicas"""
+
+    @replicas_command.command("sync")
+    @click.option("--every", type=float, default=None, help="Keep copying every N seconds")
+    def sync_command(every):
+        """Copy the SQLite primary into the SQLite replicas of DATABASE_REPLICA_URLS"""
+        primary_url = current_app.config["SQLALCHEMY_DATABASE_URI"]
+        urls = replica_urls()
+        if not primary_url.startswith("sqlite") or not all(url.startswith("sqlite") for url in urls):
+            raise click.ClickException("only SQLite primaries and replicas can be synced this way")
+        while True:
+            for url in urls:
+                sync_sqlite(primary_url, url)
+            click.echo("synced %d replica(s)" % len(urls))
+            if every is None:
+                return
+            time.sleep(every)
@@ -0,0 +1,287 @@
+"""
+Ranked search across characters, planets and vehicles: GET /search?q=...
+
+On PostgreSQL the matching and ranking run in the database on pg_trgm GIN indexes
+(migration 6a0d8b3e5f12). Elsewhere (SQLite in development) an in-process prefix +
+trigram index answers the query; it is kept up to date from the ORM writes of this
+process and rebuilt from the tables, by a background thread, when it is stale.
+"""
+import bisect
+import os
+import threading
+import time
+from flask import current_app, jsonify, request
+from sqlalchemy import event, func, literal, or_, union_all
+from sqlalchemy.orm import Session
+from models import db, Characters, Planets, Vehicles
+from cache import cached, conditional
+from utils import APIException, decode_cursor, encode_cursor, get_page_size
+
+# kind -> (model, searchable columns); the first column is the one ranked highest
+SEARCHABLE = {
+    "character": (Characters, ("name", "race", "homeworld")),
+    "planet": (Planets, ("name",)),
+    "vehicle": (Vehicles, ("name",)),
+}
+MAX_QUERY_LENGTH = 100
+MAX_OFFSET = 1000
+MIN_SCORE = 0.3
+INDEX_TTL = int(os.getenv("SEARCH_INDEX_TTL", 300))
+
+
+def trigrams(text):
+    padded = "  %s " % text
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """Prefix (sorted tokens + bisect) and trigram index over the searchable columns"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rebuild_lock = threading.Lock()  # one rebuild reads the tables at a time
+        self.built_at = None
+        self.stale = True
+        self._rebuilding = False
+        self._pending = None   # updates committed while a rebuild reads the tables
+        self._docs = {}        # (kind, id) -> [(column position, lowercased value)]
+        self._tokens = []      # sorted (token, kind, id, column position)
+        self._trigrams = {}    # trigram -> set of (kind, id)
+
+    @staticmethod
+    def _entries(kind, item_id, values):
+        """(column position, lowercased value) pairs and the tokens of one row"""
+        fields = [(position, value.lower()) for position, value in enumerate(values) if value]
+        tokens = [(token, kind, item_id, position)
+                  for position, value in fields for token in set(value.split()) | {value}]
+        return fields, tokens
+
+    def _add(self, kind, item_id, values):
+        key = (kind, item_id)
+        self._docs[key], tokens = self._entries(kind, item_id, values)
+        for token in tokens:
+            bisect.insort(self._tokens, token)
+        for position, value in self._docs[key]:
+            for trigram in trigrams(value):
+                self._trigrams.setdefault(trigram, set()).add(key)
+
+    def _remove(self, kind, item_id):
+        key = (kind, item_id)
+        for position, value in self._docs.pop(key, []):
+            for token in set(value.split()) | {value}:
+                index = bisect.bisect_left(self._tokens, (token, kind, item_id, position))
+                if index < len(self._tokens) and self._tokens[index] == (token, kind, item_id, position):
+                    del self._tokens[index]
+            for trigram in trigrams(value):
+                self._trigrams.get(trigram, set()).discard(key)
+
+    def update(self, kind, item_id, values):
+        with self._lock:
+            if self.built_at is None and self._pending is None:
+                return  # not built yet, the first build reads the row
+            if self._pending is not None:
+                self._pending.append((kind, item_id, values))
+            self._remove(kind, item_id)
+            if values is not None:
+                self._add(kind, item_id, values)
+
+    def rebuild(self):
+        """Reads the tables and swaps the new index in; searches keep using the old
+        one until then"""
+        with self._rebuild_lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        with self._lock:
+            self.stale = False
+            self._pending = []
+        try:
+            docs, tokens, trigram_index = {}, [], {}
+            for kind, (model, columns) in SEARCHABLE.items():
+                statement = db.select(model.id, *[getattr(model, column) for column in columns]).execution_options(yield_per=5000)
+                for row in db.session.execute(statement):
+                    key = (kind, row[0])
+                    docs[key], row_tokens = self._entries(kind, row[0], row[1:])
+                    tokens.extend(row_tokens)
+                    for position, value in docs[key]:
+                        for trigram in trigrams(value):
+                            trigram_index.setdefault(trigram, set()).add(key)
+            tokens.sort()
+        except Exception:
+            with self._lock:
+                self.stale, self._pending = True, None
+            raise
+        with self._lock:
+            pending, self._pending = self._pending, None
+            self._docs, self._tokens, self._trigrams = docs, tokens, trigram_index
+            self.built_at = time.monotonic()
+            # writes committed after the rows above were read
+            for kind, item_id, values in pending:
+                self.update(kind, item_id, values)
+
+    def _rebuild_in_background(self, app):
+        try:
+            with app.app_context():
+                self.rebuild()
+        finally:
+            with self._lock:
+                self._rebuilding = False
+
+    def ensure_fresh(self):
+        """Builds the index on first use; after that a stale or expired index is
+        rebuilt by a background thread while searches are answered from it"""
+        if self.built_at is None:
+            with self._rebuild_lock:
+                if self.built_at is None:
+                    self._rebuild()
+            return
+        if not self.stale and time.monotonic() - self.built_at <= INDEX_TTL:
+            return
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild_in_background, args=(current_app._get_current_object(),),
+                         name="search-index-rebuild", daemon=True).start()
+
+    def search(self, q, kinds):
+        """Returns [(score, kind, id)] best first"""
+        q = q.lower()
+        scores = {}
+        with self._lock:
+            # prefix matches on whole values and on words
+            index = bisect.bisect_left(self._tokens, (q,))
+            while index < len(self._tokens) and self._tokens[index][0].startswith(q):
+                token, kind, item_id, position = self._tokens[index]
+                index += 1
+                if kind not in kinds:
+                    continue
+                value = dict(self._docs[(kind, item_id)])[position]
+                score = 1.0 if value == q else 0.9 if value.startswith(q) else 0.7
+                score -= 0.05 * position
+                scores[(kind, item_id)] = max(scores.get((kind, item_id), 0), score)
+            # fuzzy matches through shared trigrams
+            query_trigrams = trigrams(q)
+            candidates = set()
+            for trigram in query_trigrams:
+                for key in self._trigrams.get(trigram, ()):
+                    if key[0] in kinds:
+                        candidates.add(key)
+            for key in candidates:
+                if key in scores:
+                    continue
+                for position, value in self._docs[key]:
+                    value_trigrams = trigrams(value)
+                    similarity = len(query_trigrams & value_trigrams) / len(query_trigrams | value_trigrams)
+                    if similarity >= MIN_SCORE:
+                        # fuzzy matches always rank below prefix matches
+                        score = similarity * 0.6 - 0.05 * position
+                        scores[key] = max(scores.get(key, 0), score)
+        ranked = sorted(((score, kind, item_id) for (kind, item_id), score in scores.items()),
+                        key=lambda item: (-item[0], item[1], item[2]))
+        return ranked
+
+
+search_index = SearchIndex()
+
+
+def search_postgresql(q, kinds, offset, limit):
+    selects = []
+    for kind in kinds:
+        model, columns = SEARCHABLE[kind]
+        scores = [func.similarity(getattr(model, column), q) - 0.05 * position
+                  for position, column in enumerate(columns)]
+        score = func.greatest(*scores) if len(scores) > 1 else scores[0]
+        matches = or_(*[getattr(model, column).ilike(q.replace("%", "\\%").replace("_", "\\_") + "%")
+                        for column in columns],
+                      *[getattr(model, column).op("%")(q) for column in columns])
+        selects.append(db.select(literal(kind).label("kind"), model.id.label("id"), score.label("score")).where(matches))
+    ranked = union_all(*selects).subquery()
+    statement = (db.select(ranked.c.score, ranked.c.kind, ranked.c.id)
+                 .order_by(ranked.c.score.desc(), ranked.c.kind, ranked.c.id).offset(offset).limit(limit + 1))
+    return [tuple(row) for row in db.session.execute(statement)]
+
+
+def search_in_process(q, kinds, offset, limit):
+    search_index.ensure_fresh()
+    return search_index.search(q, kinds)[offset:offset + limit + 1]
+
+
+# Keep the in-process index in step with ORM writes of this process; bulk statements
+# (ingestion...) don't say which rows they touched, they mark the index stale instead
+@event.listens_for(Session, "after_flush")
+def _collect_search_changes(session, flush_context):
+    changes = session.info.setdefault("search_changes", [])
+    for instance in list(session.new) + list(session.dirty):
+        for kind, (model, columns) in SEARCHABLE.items():
+            if isinstance(instance, model):
+                changes.append((kind, instance.id, [getattr(instance, column) for column in columns]))
+    for instance in session.deleted:
+        for kind, (model, columns) in SEARCHABLE.items():
+            if isinstance(instance, model):
+                changes.append((kind, instance.id, None))
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _bulk_search_changes(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        if orm_execute_state.statement.table.name in ("characters", "planets", "vehicles"):
+            orm_execute_state.session.info["search_stale"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_search_changes(session):
+    if session.info.pop("search_stale", False):
+        search_index.stale = True
+    for kind, item_id, values in session.info.pop("search_changes", []):
+        search_index.update(kind, item_id, values)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_search_changes(session):
+    session.info.pop("search_changes", None)
+    session.info.pop("search_stale", None)
+
+
+def setup_search(app):
+
+    # Endpoint to search characters, planets and vehicles by name (and race/homeworld)
+    @app.route('/search', methods=['GET'])
+    @conditional("characters", "planets", "vehicles")
+    @cached("characters", "planets", "vehicles")
+    def search():
+        q = request.args.get("q", "").strip()
+        if not q:
+            raise APIException("q is required", status_code=400)
+        if len(q) > MAX_QUERY_LENGTH:
+            raise APIException("q can be at most %d characters" % MAX_QUERY_LENGTH, status_code=400)
+        types = request.args.get("types")
+        kinds = [kind.strip() for kind in types.split(",")] if types else list(SEARCHABLE)
+        if any(kind not in SEARCHABLE for kind in kinds):
+            raise APIException("types must be a list of %s" % ", ".join(SEARCHABLE), status_code=400)
+        limit = get_page_size()
+        offset = decode_cursor(request.args["cursor"]) if request.args.get("cursor") else 0
+        if offset < 0 or offset > MAX_OFFSET:
+            raise APIException("Invalid cursor", status_code=400)
+
+        if db.session.get_bind().dialect.name == "postgresql":
+            ranked = search_postgresql(q, kinds, offset, limit)
+        else:
+            ranked = search_in_process(q, kinds, offset, limit)
+        next_cursor = encode_cursor(offset + limit) if len(ranked) > limit and offset + limit <= MAX_OFFSET else None
+        ranked = ranked[:limit]
+
+        # one IN (...) query per type for the page's rows
+        found = {}
+        for kind in kinds:
+            model = SEARCHABLE[kind][0]
+            ids = [item_id for score, result_kind, item_id in ranked if result_kind == kind]
+            if ids:
+                statement = db.select(*model.serialized_columns()).where(model.id.in_(ids))
+                found.update({(kind, row.id): model.serialize_row(row) for row in db.session.execute(statement)})
+        results = [{"type": kind, "id": item_id, "score": round(float(score), 3), "result": found[(kind, item_id)]}
+                   for score, kind, item_id in ranked if (kind, item_id) in found]
+
+        if results == []:
+            return jsonify({"msg": "No results found"}), 404
+        return jsonify({"msg": "All ok", "results": results, "next": next_cursor}), 200
@@ -1,4 +1,16 @@
-from flask import jsonify, url_for
+import base64
+import binascii
+import json
+import sys
+from flask import jsonify, url_for, request
+from sqlalchemy import and_, or_
+
+# Keyset pagination: pages are ordered by primary key (or by a sort column, then
+# primary key) and the cursor is an opaque token holding the last key of the
+# previous page.
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MAX_BATCH_IDS = 100
 
 class APIException(Exception):
     status_code = 400
@@ -15,6 +27,174 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def encode_cursor(value):
+    raw = json.dumps(value, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_cursor_value(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return json.loads(raw)
+    except (binascii.Error, ValueError):
+        raise APIException("Invalid cursor", status_code=400)
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def decode_cursor(cursor):
+    value = _decode_cursor_value(cursor)
+    if not _is_int(value):
+        raise APIException("Invalid cursor", status_code=400)
+    return value
+
+def decode_sort_cursor(cursor, value_type):
+    """[sort column value, id]; the value must be a `value_type` (the column's
+    python type), anything else would reach the database as a bad parameter"""
+    value = _decode_cursor_value(cursor)
+    if not (isinstance(value, list) and len(value) == 2 and _is_int(value[1])):
+        raise APIException("Invalid cursor", status_code=400)
+    if not (_is_int(value[0]) if value_type is int else isinstance(value[0], value_type)):
+        raise APIException("Invalid cursor", status_code=400)
+    return value
+
+def get_page_size():
+    return parse_page_size(request.args.get("limit"))
+
+def parse_page_size(limit):
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise APIException("limit must be an integer", status_code=400)
+    if limit < 1:
+        raise APIException("limit must be greater than 0", status_code=400)
+    return min(limit, MAX_PAGE_SIZE)
+
+def paginate(query, model, sort_column=None, descending=False):
+    """Returns one page of `query` and the cursor for the next page (or None)"""
+    limit = get_page_size()
+    cursor = request.args.get("cursor")
+    if sort_column is None:
+        if cursor:
+            query = query.filter(model.id > decode_cursor(cursor))
+        order = (model.id,)
+    else:
+        # rows without a value have no place in the keyset order, sorting leaves them out
+        query = query.filter(sort_column.isnot(None))
+        if cursor:
+            value, last_id = decode_sort_cursor(cursor, sort_column.type.python_type)
+            if descending:
+                query = query.filter(or_(sort_column < value, and_(sort_column == value, model.id < last_id)))
+            else:
+                query = query.filter(or_(sort_column > value, and_(sort_column == value, model.id > last_id)))
+        order = (sort_column.desc(), model.id.desc()) if descending else (sort_column, model.id)
+    # fetch one extra row so we know if there is a next page without a COUNT(*)
+    rows = query.order_by(*order).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last.id if sort_column is None else [getattr(last, sort_column.key), last.id])
+    return rows, next_cursor
+
+def apply_filters(query, model, filters):
+    """Applies the ?param=value filters of `filters` ({param: (operator, column attribute, type)}).
+    Returns the query and the column of the first range filter used (or None)"""
+    range_column = None
+    for param, (operator, attr, value_type) in filters.items():
+        value = request.args.get(param)
+        if value is None or value == "":
+            continue
+        try:
+            value = value_type(value)
+        except ValueError:
+            raise APIException("%s must be of type %s" % (param, value_type.__name__), status_code=400)
+        column = getattr(model, attr)
+        if operator != "eq" and range_column is None:
+            range_column = column
+        if operator == "eq":
+            query = query.filter(column == value)
+        elif operator == "ge":
+            query = query.filter(column >= value)
+        elif operator == "le":
+            query = query.filter(column <= value)
+        elif operator == "prefix":
+            query = query.filter(prefix_range(column, value))
+    return query, range_column
+
+def prefix_range(column, prefix):
+    """`column` starts with `prefix` (case sensitive), as a range instead of LIKE 'x%'
+    so a plain B-tree index serves it on every database"""
+    # the last character that can be incremented: nothing sorts after U+10FFFF
+    stem = prefix.rstrip(chr(sys.maxunicode))
+    if not stem:
+        return column >= prefix
+    following = ord(stem[-1]) + 1
+    if 0xD800 <= following <= 0xDFFF:
+        # surrogates are not characters, no database would take one
+        following = 0xE000
+    return and_(column >= prefix, column < stem[:-1] + chr(following))
+
+def parse_sort(model, sortable):
+    """Reads ?sort=column or ?sort=-column, returns (column, descending) or (None, False)"""
+    value = request.args.get("sort")
+    if not value:
+        return None, False
+    descending = value.startswith("-")
+    attr = value.lstrip("-")
+    if attr not in sortable:
+        raise APIException("Can't sort on %s" % attr, status_code=400, payload={"sortable": list(sortable)})
+    return getattr(model, attr), descending
+
+def parse_fields(model):
+    return parse_fields_value(model, request.args.get("fields"))
+
+def parse_fields_value(model, value):
+    """Serialized keys asked for in ?fields=a,b (None means all of them), checked against the model"""
+    if not value:
+        return None
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in model.serialized_fields]
+    if unknown or not fields:
+        raise APIException("Unknown fields: %s" % ", ".join(unknown), status_code=400,
+                           payload={"allowed fields": list(model.serialized_fields)})
+    return list(dict.fromkeys(fields))
+
+def parse_ids(value):
+    """Ids asked for in ?ids=1,5,9, in request order without repeats"""
+    try:
+        ids = [int(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        raise APIException("ids must be a comma separated list of integers", status_code=400)
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        raise APIException("ids must list at least one id", status_code=400)
+    if len(ids) > MAX_BATCH_IDS:
+        raise APIException("at most %d ids can be fetched at once" % MAX_BATCH_IDS, status_code=400)
+    return ids
+
+def projection(fields):
+    """Keys to SELECT for `fields`: the id always comes first, pagination needs it"""
+    if fields is None:
+        return None
+    return ["id"] + [field for field in fields if field != "id"]
+
+def insert_ignore(table, session):
+    """INSERT that silently skips rows hitting a unique constraint, in the current dialect"""
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect in ("mysql", "mariadb"):
+        # not INSERT IGNORE: that would also swallow foreign key errors
+        from sqlalchemy.dialects.mysql import insert
+        return insert(table).on_duplicate_key_update(id=table.c.id)
+    raise NotImplementedError("insert_ignore is not supported on %s" % dialect)
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
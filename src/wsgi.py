@@ -1,7 +1,35 @@
 # This file was created to run the application on heroku using gunicorn.
 # Read more about it here: https://devcenter.heroku.com/articles/python-gunicorn
+#
+# Workers serve the API (APP_ROLE, "api" by default). The admin UI is built on the
+# first request to /admin instead of at boot, so workers that never see one never
+# import Flask-Admin.
+import os
+import threading
+from app import create_app, parse_roles
 
-from app import app as application
+
+class LazyAdmin:
+    """WSGI app sending /admin to an admin app created on first use, everything else to `app`"""
+
+    def __init__(self, app):
+        self.app = app
+        self.admin_app = None
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO", "").startswith("/admin"):
+            if self.admin_app is None:
+                with self._lock:
+                    if self.admin_app is None:
+                        self.admin_app = create_app("admin")
+            return self.admin_app(environ, start_response)
+        return self.app(environ, start_response)
+
+
+role = os.getenv("APP_ROLE", "api")
+app = create_app(role)
+application = app if "admin" in parse_roles(role) else LazyAdmin(app)
 
 if __name__ == "__main__":
-    application.run()
+    app.run()
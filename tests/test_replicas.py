@@ -0,0 +1,182 @@
+"""
+Read replicas against two local SQLite files, the primary and its one replica.
+
+The replica only changes when a test copies the primary into it (sync_sqlite),
+which makes the replication lag as long as a test needs it to be.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+DIRECTORY = tempfile.mkdtemp(prefix="swapi-replicas-")
+PRIMARY_URL = "sqlite:///" + os.path.join(DIRECTORY, "primary.db")
+REPLICA_URL = "sqlite:///" + os.path.join(DIRECTORY, "replica.db")
+os.environ["DATABASE_URL"] = PRIMARY_URL
+os.environ["DATABASE_REPLICA_URLS"] = REPLICA_URL
+os.environ["REPLICA_STICKY_SECONDS"] = "2"
+os.environ["REPLICA_HEALTH_INTERVAL"] = "3600"
+os.environ["RATELIMIT_DISABLED"] = "1"
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC)
+
+from sqlalchemy import create_engine  # noqa: E402
+from app import create_app  # noqa: E402
+from cache import LocalCache, body_etag, response_cache  # noqa: E402
+from models import Characters, db  # noqa: E402
+from replicas import STICKY_COOKIE, STICKY_SECONDS, Replica, replica_set, sticky_clients, sync_sqlite  # noqa: E402
+
+app = create_app("api")
+
+with app.app_context():
+    db.create_all(bind_key=None)
+    db.session.add(Characters(name="Luke", race="human", homeworld="Tatooine"))
+    db.session.commit()
+
+
+def add_character(name):
+    """Commits a character to the primary only, outside of any request"""
+    with app.app_context():
+        character = Characters(name=name, race="human", homeworld="Naboo")
+        db.session.add(character)
+        db.session.commit()
+        return character.id
+
+
+def client(address):
+    test_client = app.test_client()
+    test_client.environ_base["REMOTE_ADDR"] = address
+    return test_client
+
+
+class ReplicaTestCase(unittest.TestCase):
+    def setUp(self):
+        sync_sqlite(PRIMARY_URL, REPLICA_URL)
+        response_cache.backend.clear()
+        sticky_clients.clear()
+        for replica in replica_set.replicas:
+            replica.ejected_until = 0
+
+    def wait_for_window(self):
+        time.sleep(STICKY_SECONDS + 0.1)
+
+
+class RoutingTest(ReplicaTestCase):
+    def test_gets_read_from_the_replica(self):
+        character_id = add_character("Leia")
+        self.assertEqual(client("10.0.0.1").get("/characters/%d" % character_id).status_code, 404)
+        sync_sqlite(PRIMARY_URL, REPLICA_URL)
+        self.wait_for_window()
+        self.assertEqual(client("10.0.0.1").get("/characters/%d" % character_id).status_code, 200)
+
+    def test_writes_go_to_the_primary(self):
+        response = client("10.0.0.1").post("/characters", json={"name": "Han", "race": "human", "homeworld": "Corellia"})
+        self.assertEqual(response.status_code, 200)
+        with app.app_context():
+            self.assertIsNotNone(Characters.query.filter_by(name="Han").first())
+        replica = create_engine(REPLICA_URL)
+        try:
+            with replica.connect() as connection:
+                count = connection.exec_driver_sql("SELECT count(*) FROM characters WHERE name = 'Han'").scalar()
+        finally:
+            replica.dispose()
+        self.assertEqual(count, 0)
+
+
+class StickinessTest(ReplicaTestCase):
+    def test_writer_reads_its_writes(self):
+        writer = client("10.0.0.2")
+        response = writer.post("/characters", json={"name": "Chewbacca", "race": "wookiee", "homeworld": "Kashyyyk"})
+        self.assertIsNotNone(writer.get_cookie(STICKY_COOKIE))
+        with app.app_context():
+            character_id = Characters.query.filter_by(name="Chewbacca").first().id
+        # another client still reads the replica, which has not caught up
+        self.assertEqual(client("10.0.0.3").get("/characters/%d" % character_id).status_code, 404)
+        self.assertEqual(writer.get("/characters/%d" % character_id).status_code, 200)
+
+    def test_stickiness_follows_the_client_without_its_cookie(self):
+        client("10.0.0.4").post("/characters", json={"name": "Lando", "race": "human", "homeworld": "Socorro"})
+        with app.app_context():
+            character_id = Characters.query.filter_by(name="Lando").first().id
+        # a new cookie jar, same address: the worker remembers the client
+        self.assertEqual(client("10.0.0.4").get("/characters/%d" % character_id).status_code, 200)
+
+    def test_stickiness_ends(self):
+        writer = client("10.0.0.5")
+        writer.post("/characters", json={"name": "Wedge", "race": "human", "homeworld": "Corellia"})
+        with app.app_context():
+            character_id = Characters.query.filter_by(name="Wedge").first().id
+        self.wait_for_window()
+        self.assertEqual(writer.get("/characters/%d" % character_id).status_code, 404)
+
+
+class EjectionTest(ReplicaTestCase):
+    def test_ejected_replica_falls_back_to_the_primary(self):
+        character_id = add_character("Mon Mothma")
+        replica_set.replicas[0].eject("test")
+        self.assertIsNone(replica_set.choose())
+        self.assertEqual(client("10.0.0.6").get("/characters/%d" % character_id).status_code, 200)
+
+    def test_failed_probe_ejects(self):
+        broken = Replica("broken", create_engine("sqlite:////nonexistent/directory/replica.db"))
+        self.assertTrue(broken.available())
+        broken.probe()
+        self.assertFalse(broken.available())
+
+    def test_failing_replica_is_ejected_mid_request(self):
+        character_id = add_character("Ackbar")
+        replicas = replica_set.replicas
+        broken = Replica("broken", create_engine("sqlite:////nonexistent/directory/replica.db"))
+        replica_set.replicas = [broken]
+        try:
+            response = client("10.0.0.7").get("/characters/%d" % character_id)
+        finally:
+            replica_set.replicas = replicas
+        # run again on the primary, the replica is out of rotation
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(broken.available())
+
+
+class ResponseCacheTest(ReplicaTestCase):
+    def test_replica_reads_after_a_write_are_not_cached(self):
+        writer, reader = client("10.0.0.8"), client("10.0.0.9")
+        writer.post("/characters", json={"name": "Boba", "race": "human", "homeworld": "Kamino"})
+        with app.app_context():
+            character_id = Characters.query.filter_by(name="Boba").first().id
+        response = reader.get("/characters/%d" % character_id)
+        self.assertEqual((response.status_code, response.headers["X-Cache"]), (404, "MISS"))
+        # the stale 404 of the replica was not stored for the writer to get
+        response = writer.get("/characters/%d" % character_id)
+        self.assertEqual((response.status_code, response.headers["X-Cache"]), (200, "MISS"))
+        # read from the primary, that one is fresh enough for everyone
+        response = reader.get("/characters/%d" % character_id)
+        self.assertEqual((response.status_code, response.headers["X-Cache"]), (200, "HIT"))
+
+    def test_replica_reads_after_a_write_get_no_version_etag(self):
+        backend = response_cache.backend
+        response_cache.backend = LocalCache()
+        response_cache.backend.shared = True  # version ETags, as with Redis
+        try:
+            client("10.0.0.11").post("/characters", json={"name": "Jyn", "race": "human", "homeworld": "Vallt"})
+            response = client("10.0.0.12").get("/characters")
+        finally:
+            response_cache.backend = backend
+        # the tag of the body the replica had, not of the versions its write bumped
+        self.assertEqual(response.get_etag()[0], body_etag(response.get_data()))
+
+    def test_replica_reads_are_cached_after_the_window(self):
+        character_id = add_character("Jabba")
+        sync_sqlite(PRIMARY_URL, REPLICA_URL)
+        self.wait_for_window()
+        reader = client("10.0.0.10")
+        self.assertEqual(reader.get("/characters/%d" % character_id).headers["X-Cache"], "MISS")
+        response = reader.get("/characters/%d" % character_id)
+        self.assertEqual((response.status_code, response.headers["X-Cache"]), (200, "HIT"))
+
+
+if __name__ == "__main__":
+    unittest.main()